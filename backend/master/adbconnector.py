@@ -0,0 +1,358 @@
+# master/adbconnector.py
+import asyncio
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from acouchbase.cluster import Cluster
+from couchbase.options import (
+    ClusterOptions,
+    ClusterTimeoutOptions,
+    GetAnyReplicaOptions,
+    GetOptions,
+    LookupInOptions,
+    QueryOptions,
+)
+from couchbase.auth import PasswordAuthenticator
+from couchbase.exceptions import CouchbaseException, DocumentNotFoundException, DocumentUnretrievableException
+
+import metrics
+import deadline
+from deadline import DeadlineExceeded, OPERATION_TIMEOUTS
+from dbconnector import (
+    DB_CONN_STR,
+    DB_USERNAME,
+    DB_PASSWORD,
+    HEDGE_DELAY,
+    HEDGED_READS,
+    RECONNECT_BACKOFF,
+    RECOMMENDATIONS_COLLECTION,
+    array_slice_specs,
+    array_slice_values,
+    is_timeout_error,
+    normalize_title,
+    recommendation_key_by_title,
+    replica_array_slice,
+)
+
+
+@contextmanager
+def operation_timeout(operation_type: str):
+    """Timeout of an operation within the request deadline, like dbconnector.couchbase_operation"""
+    try:
+        yield deadline.timeout_for(operation_type)
+    except Exception as e:
+        if is_timeout_error(e) and deadline.expired():
+            raise DeadlineExceeded(f"Request deadline exceeded during a {operation_type} operation") from e
+        raise
+
+
+class AsyncCouchbaseClient(object):
+    """Class to handle interactions with Couchbase cluster through the asyncio API"""
+
+    def __init__(self) -> None:
+        self.cluster = None
+        self.bucket = None
+        self.scope = None
+        self.collection_names = set()
+        self.conn_str = DB_CONN_STR
+        self.bucket_name = "recommender"
+        self.scope_name = "_default"
+        self.username = DB_USERNAME
+        self.password = DB_PASSWORD
+
+    async def connect(self) -> None:
+        """Connect to the Couchbase cluster"""
+        if self.cluster:
+            return
+        try:
+            auth = PasswordAuthenticator(self.username, self.password)
+            timeout_opts = ClusterTimeoutOptions(
+                connect_timeout=timedelta(seconds=OPERATION_TIMEOUTS["connect"]),
+                kv_timeout=timedelta(seconds=OPERATION_TIMEOUTS["kv"]),
+                query_timeout=timedelta(seconds=OPERATION_TIMEOUTS["query"]),
+            )
+            cluster_opts = ClusterOptions(auth, timeout_options=timeout_opts)
+
+            self.cluster = await Cluster.connect(self.conn_str, cluster_opts)
+            await self.cluster.wait_until_ready(deadline.timeout_for("connect"))
+
+            self.bucket = self.cluster.bucket(self.bucket_name)
+            await self.bucket.on_connect()
+
+            scopes_in_bucket = {
+                scope.name: scope for scope in await self.bucket.collections().get_all_scopes()
+            }
+        except CouchbaseException as error:
+            print(f"Could not connect to cluster. \nError: {error}")
+            await self.close()
+            raise
+
+        if self.scope_name not in scopes_in_bucket:
+            await self.close()
+            raise RuntimeError(f"Scope '{self.scope_name}' does not exist in bucket '{self.bucket_name}'")
+        self.collection_names = {
+            collection.name for collection in scopes_in_bucket[self.scope_name].collections
+        }
+        self.scope = self.bucket.scope(self.scope_name)
+
+    async def close(self) -> None:
+        """Close the connection to the Couchbase cluster"""
+        cluster, self.cluster = self.cluster, None
+        self.bucket = None
+        self.scope = None
+        if cluster:
+            try:
+                await cluster.close()
+            except Exception as e:
+                print(f"Error closing cluster connection: {e}")
+
+    async def get_document(self, collection_name: str, key: str):
+        """Get document by key using KV operation"""
+        with operation_timeout("kv") as timeout:
+            return await self.scope.collection(collection_name).get(key, GetOptions(timeout=timeout))
+
+    async def get_documents(self, collection_name: str, keys: list[str]) -> tuple[dict, dict]:
+        """Get many documents concurrently, returns values and errors by key"""
+        results = await asyncio.gather(
+            *(self.get_document(collection_name, key) for key in keys), return_exceptions=True
+        )
+        values, errors = {}, {}
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                errors[key] = result
+            else:
+                values[key] = result.value
+        return values, errors
+
+    async def get_array_slice(self, collection_name: str, key: str, path: str, offset: int, k: int) -> tuple[list, int]:
+        """Get the elements [offset, offset + k) of an array in a document and the document CAS,
+        hedged with a replica read when the primary is slow and hedged reads are enabled"""
+        primary = asyncio.ensure_future(self._lookup_array_slice(collection_name, key, path, offset, k))
+        if not HEDGED_READS:
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=HEDGE_DELAY)
+        if done:
+            metrics.HEDGED_READS.labels("primary").inc()
+            return primary.result()
+
+        replica = asyncio.ensure_future(self._get_array_slice_from_replica(collection_name, key, path, offset, k))
+        reads = {primary: "primary_after_hedge", replica: "replica"}
+        try:
+            while reads:
+                done, _ = await asyncio.wait(reads, return_when=asyncio.FIRST_COMPLETED)
+                for read in done:
+                    outcome = reads.pop(read)
+                    # A failed read only matters when the other one fails too
+                    if read.exception() is None or not reads:
+                        metrics.HEDGED_READS.labels(outcome if read.exception() is None else "failed").inc()
+                        return read.result()
+        finally:
+            for read in reads:
+                read.cancel()
+
+    async def _get_array_slice_from_replica(self, collection_name: str, key: str, path: str, offset: int, k: int) -> tuple[list, int]:
+        try:
+            with operation_timeout("kv") as timeout:
+                res = await self.scope.collection(collection_name).get_any_replica(key, GetAnyReplicaOptions(timeout=timeout))
+        except DocumentUnretrievableException as e:
+            # No copy has the document, the same answer as a primary read of a missing document
+            raise DocumentNotFoundException(message=f"No replica of {key} found") from e
+        return replica_array_slice(res.value, path, offset, k), res.cas
+
+    async def _lookup_array_slice(self, collection_name: str, key: str, path: str, offset: int, k: int) -> tuple[list, int]:
+        collection = self.scope.collection(collection_name)
+        with operation_timeout("kv") as timeout:
+            results = await asyncio.gather(
+                *(collection.lookup_in(key, specs, LookupInOptions(timeout=timeout)) for specs in array_slice_specs(path, offset, k))
+            )
+        values = []
+        for res in results:
+            found, ended = array_slice_values(res)
+            values += found
+            if ended:
+                break
+        return values, results[0].cas if results else None
+
+    async def query(self, sql_query, *options, timeout_type: str = "query", **kwargs) -> list:
+        """Query Couchbase using SQL++ and collect all rows"""
+        with operation_timeout(timeout_type) as timeout:
+            q_res = self.scope.query(sql_query, *options, timeout=timeout, **kwargs)
+            return [row async for row in q_res.rows()]
+
+    async def get_autosuggestion_by_name(self, query_name: str, limit: int = 5) -> list[str]:
+        """Get top autosuggestion movie names by name"""
+        q_str = 'SELECT t.title FROM `movies` t WHERE LOWER(t.title) LIKE $title LIMIT $limit;'
+        q_res = await self.query(q_str, QueryOptions(named_parameters={'title': query_name.lower() + '%', 'limit': limit}))
+        return [item['title'] for item in q_res]
+
+    async def get_all_movie_titles(self) -> list[dict]:
+        """Get the id and title of every movie"""
+        return await self.query('SELECT t.movieId, t.title FROM `movies` t;', timeout_type='bulk_query')
+
+    async def get_movie_rating_counts(self) -> dict:
+        """Get the number of reviews of each movie"""
+        q_str = 'SELECT r.movieId, COUNT(1) AS ratings FROM `reviews` r GROUP BY r.movieId;'
+        return {int(item['movieId']): item['ratings'] for item in await self.query(q_str, timeout_type='bulk_query')}
+
+    async def get_user_ratings(self, user_id: int, limit: int) -> tuple[list[int], list[float]]:
+        """Get the ids of the movies rated by a user and the ratings, at most limit of them.
+
+        Covered by the idx_reviews_user_ratings index created by couchbase-connector/dbimport.py.
+        """
+        q_str = 'SELECT r.movieId, r.rating FROM `reviews` r WHERE r.userId = $user_id LIMIT $limit;'
+        q_res = await self.query(q_str, QueryOptions(named_parameters={'user_id': user_id, 'limit': limit}))
+        return [int(item['movieId']) for item in q_res], [float(item['rating']) for item in q_res]
+
+    async def get_movie_id_by_name(self, name: str):
+        """Get the id of a movie by title, or None if there is no such movie"""
+        q_str = 'SELECT RAW t.movieId FROM `movies` t WHERE LOWER(t.title) = $title LIMIT 1;'
+        q_res = await self.query(q_str, QueryOptions(named_parameters={'title': name.lower()}))
+        return q_res[0] if q_res else None
+
+    async def get_movie_ids_by_names(self, names: list[str]) -> dict:
+        """Get movie ids by normalised title, in a single query"""
+        q_str = 'SELECT t.movieId, LOWER(t.title) AS title FROM `movies` t WHERE LOWER(t.title) IN $titles;'
+        q_res = await self.query(q_str, QueryOptions(named_parameters={'titles': [normalize_title(name) for name in names]}))
+        return {normalize_title(item['title']): item['movieId'] for item in q_res}
+
+    async def get_movie_docs_by_id(self, movie_ids: list[str]) -> dict:
+        """Get movie titles by id"""
+        q_str = 'SELECT META().id, t.title FROM `movies` t WHERE META().id IN $movie_ids;'
+        q_res = await self.query(q_str, QueryOptions(named_parameters={'movie_ids': movie_ids}))
+        return {item['id']: item['title'] for item in q_res}
+
+    async def get_precomputed_recommendations(self, movieName: str, offset: int = 0, k: int = 10):
+        """Get a page of the recommendations document written by dbimport.py and its CAS,
+        or None if there is no such document"""
+        if RECOMMENDATIONS_COLLECTION not in self.collection_names:
+            return None
+        try:
+            return await self.get_array_slice(
+                RECOMMENDATIONS_COLLECTION, recommendation_key_by_title(movieName), "recommendedMovies", offset, k
+            )
+        except DocumentNotFoundException:
+            return None
+
+    async def get_recommendations(self, movieName: str, catalog=None, offset: int = 0, k: int = 10) -> list[dict]:
+        return (await self.get_recommendations_with_cas(movieName, catalog, offset, k))[0]
+
+    async def get_recommendations_with_cas(self, movieName: str, catalog=None, offset: int = 0, k: int = 10) -> tuple[list[dict], int]:
+        """Get the recommendations [offset, offset + k) and the CAS of the document they were read from"""
+        # The precomputed document and the N1QL title lookup do not depend on each
+        # other, so the lookup is started right away in case there is no document
+        movie_id_lookup = None
+        if catalog is None:
+            movie_id_lookup = asyncio.ensure_future(self.get_movie_id_by_name(movieName))
+        try:
+            # Precomputed documents only hold the best recommendations, the rest of a page is in the neighbor list
+            page = await self.get_precomputed_recommendations(movieName, offset, k)
+            if page is not None and len(page[0]) == k:
+                return page
+
+            if movie_id_lookup is not None:
+                movie_doc_id = await movie_id_lookup
+            else:
+                movie_doc_id = catalog.get_movie_id(movieName)
+        finally:
+            if movie_id_lookup is not None and not movie_id_lookup.done():
+                movie_id_lookup.cancel()
+
+        if movie_doc_id is None:
+            return page or ([], None)
+
+        # Only the requested page of the neighbor list is read
+        try:
+            recommendation_results, cas = await self.get_array_slice('results', str(movie_doc_id), "", offset, k)
+        except DocumentNotFoundException:
+            return page or ([], None)
+        movie_ids = [str(item['movieId']) for item in recommendation_results]
+        if catalog is not None:
+            movie_docs = catalog.get_titles(movie_ids)
+        else:
+            movie_docs = await self.get_movie_docs_by_id(movie_ids) if movie_ids else {}
+        for item in recommendation_results:
+            item['title'] = movie_docs.get(str(item['movieId']))
+        return recommendation_results, cas
+
+    async def get_neighbor_lists(self, movie_ids: list[int]) -> dict:
+        """Get the whole neighbor lists of many movies from the results collection concurrently.
+
+        Returns a dict from movie id to its list of {"movieId", "avg_score"}, None when
+        the movie has no results document, or the exception raised while fetching it.
+        """
+        keys = list(dict.fromkeys(str(movie_id) for movie_id in movie_ids))
+        values, errors = await self.get_documents('results', keys)
+
+        neighbor_lists = {}
+        for key in keys:
+            if key in values:
+                neighbor_lists[int(key)] = values[key]
+            elif isinstance(errors.get(key), DocumentNotFoundException):
+                neighbor_lists[int(key)] = None
+            else:
+                neighbor_lists[int(key)] = errors[key]
+        return neighbor_lists
+
+    async def get_recommendations_batch(self, movie_ids: list[int], catalog=None, limit: int = 10) -> dict:
+        """Get recommendations of many movies concurrently, with one title lookup.
+
+        Returns a dict from movie id to its recommendations, None when the movie has
+        no results document, or the exception raised while fetching it.
+        """
+        recommendations = {
+            movie_id: [dict(item) for item in neighbors[:limit]] if isinstance(neighbors, list) else neighbors
+            for movie_id, neighbors in (await self.get_neighbor_lists(movie_ids)).items()
+        }
+
+        neighbor_ids = list({
+            str(item['movieId'])
+            for items in recommendations.values() if isinstance(items, list)
+            for item in items
+        })
+        if catalog is not None:
+            movie_docs = catalog.get_titles(neighbor_ids)
+        else:
+            movie_docs = await self.get_movie_docs_by_id(neighbor_ids) if neighbor_ids else {}
+        for items in recommendations.values():
+            if isinstance(items, list):
+                for item in items:
+                    item['title'] = movie_docs.get(str(item['movieId']))
+        return recommendations
+
+
+# One client per event loop, shared by all requests of that worker
+_shared_client = None
+_shared_client_lock = None
+_last_connect_failure = 0.0
+
+
+async def get_client() -> AsyncCouchbaseClient:
+    """Return the shared asynchronous Couchbase client, connecting on first use"""
+    global _shared_client, _shared_client_lock, _last_connect_failure
+    if _shared_client is not None:
+        return _shared_client
+
+    if _shared_client_lock is None:
+        _shared_client_lock = asyncio.Lock()
+    async with _shared_client_lock:
+        if _shared_client is not None:
+            return _shared_client
+        if time.monotonic() - _last_connect_failure < RECONNECT_BACKOFF:
+            raise RuntimeError("Couchbase cluster is unavailable, retrying connection later")
+        client = AsyncCouchbaseClient()
+        try:
+            await client.connect()
+        except Exception:
+            _last_connect_failure = time.monotonic()
+            raise
+        _shared_client = client
+        return client
+
+
+async def reset_client(client: AsyncCouchbaseClient = None) -> None:
+    """Drop the shared client so that the next get_client() call reconnects"""
+    global _shared_client
+    if _shared_client is None or (client is not None and client is not _shared_client):
+        return
+    client, _shared_client = _shared_client, None
+    await client.close()
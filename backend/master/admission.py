@@ -0,0 +1,136 @@
+# master/admission.py
+# Admission control of a worker: at most max_concurrent requests run at once and
+# at most max_queue wait for a slot, cheap requests ahead of expensive ones. A
+# cheap request arriving at a full queue takes the place of the latest expensive
+# one. Anything beyond that is shed right away, so that under overload latency stays
+# bounded by the queue timeout instead of growing until gunicorn kills the worker.
+import threading
+import time
+from collections import deque
+
+import metrics
+
+# Priorities, requests answered from memory are admitted before those going to Couchbase
+CHEAP = "cheap"
+EXPENSIVE = "expensive"
+
+
+class AdmissionController(object):
+    """Concurrency limit with a bounded, prioritised wait queue"""
+
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.admitted = 0
+        self.shed = 0
+        # Tickets of waiting requests in arrival order, per priority
+        self._queues = {CHEAP: deque(), EXPENSIVE: deque()}
+        # Tickets taken out of the queue to make room for a higher priority request
+        self._evicted = set()
+        self._changed = threading.Condition()
+
+    def acquire(self, priority: str, timeout: float = None) -> bool:
+        """Wait for a slot, at most timeout (or queue_timeout) seconds; False if the request is shed"""
+        timeout = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        with self._changed:
+            if self.active < self.max_concurrent and not self._queued():
+                return self._admit()
+            if self._queued() >= self.max_queue and not self._evict_below(priority):
+                return self._shed(priority, "queue_full")
+
+            ticket = object()
+            queue = self._queues[priority]
+            queue.append(ticket)
+            metrics.REQUESTS_QUEUED.labels(priority).inc()
+            try:
+                expires_at = time.monotonic() + timeout
+                while not (self.active < self.max_concurrent and self._next_ticket() is ticket):
+                    if ticket in self._evicted:
+                        self._evicted.remove(ticket)
+                        return self._shed(priority, "evicted")
+                    remaining = expires_at - time.monotonic()
+                    if remaining <= 0:
+                        return self._shed(priority, "queue_timeout")
+                    self._changed.wait(remaining)
+                return self._admit()
+            finally:
+                if ticket in queue:
+                    queue.remove(ticket)
+                    metrics.REQUESTS_QUEUED.labels(priority).dec()
+                # The next ticket may be admissible now that this one left the queue
+                self._changed.notify_all()
+
+    def release(self) -> None:
+        with self._changed:
+            self.active -= 1
+            self._changed.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": {priority: len(queue) for priority, queue in self._queues.items()},
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "shed": self.shed,
+        }
+
+    def _queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def _next_ticket(self):
+        for priority in (CHEAP, EXPENSIVE):
+            if self._queues[priority]:
+                return self._queues[priority][0]
+        return None
+
+    def _evict_below(self, priority: str) -> bool:
+        """Make room in the queue for a request by evicting the latest waiter of a lower priority"""
+        if priority != CHEAP or not self._queues[EXPENSIVE]:
+            return False
+        self._evicted.add(self._queues[EXPENSIVE].pop())
+        metrics.REQUESTS_QUEUED.labels(EXPENSIVE).dec()
+        # Wake the evicted request up so that it is answered right away
+        self._changed.notify_all()
+        return True
+
+    def _admit(self) -> bool:
+        self.active += 1
+        self.admitted += 1
+        return True
+
+    def _shed(self, priority: str, reason: str) -> bool:
+        self.shed += 1
+        metrics.REQUESTS_SHED.labels(priority, reason).inc()
+        return False
+
+
+def init_app(app, controller: AdmissionController, classify, retry_after: int = 1) -> None:
+    """Admit the requests of a Flask app through controller.
+
+    classify() returns the priority of the current request, or None for requests
+    that are always admitted, e.g. health checks.
+    """
+    from flask import g, jsonify
+    import deadline
+
+    @app.before_request
+    def admit_request():
+        priority = classify()
+        if priority is None:
+            return None
+        # Waiting longer than the request deadline would only produce a 504 later
+        if controller.acquire(priority, deadline.remaining()):
+            g.admitted = True
+            return None
+        response = jsonify({"error": "Service overloaded, retry later"})
+        response.status_code = 503
+        response.headers["Retry-After"] = str(retry_after)
+        return response
+
+    @app.teardown_request
+    def release_request(error=None):
+        if g.pop("admitted", False):
+            controller.release()
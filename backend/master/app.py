@@ -1,126 +1,565 @@
 # master/app.py
+import math
 import os
-from flask import Flask, jsonify
-from dbconnector import CouchbaseClient
+import threading
+import time
+from flask import Flask, g, has_request_context, jsonify, request
+from dbconnector import get_client, reset_client, is_connection_error, normalize_title
 from flask_cors import CORS
+from cache import TTLCache
+from service import (
+    USE_DUMMY_DATA, RECOMMENDATION_CACHE_SIZE, RECOMMENDATION_CACHE_TTL, RECOMMENDATION_CACHE_STALE_TTL,
+    RECOMMENDATION_CACHE_NEGATIVE_TTL, NEIGHBOR_FALLBACK_TO_COUCHBASE, neighbor_table, item_index,
+    DEFAULT_PAGE_SIZE, MAX_BATCH_SIZE, MAX_USER_RATINGS, MOVIE_TITLES_PATH, WARMUP_TITLES, WARMUP_TITLES_PATH,
+    HOT_TITLES_PATH, dummy_data, page_params, body_page_size, parse_batch, similar_movies_response,
+    approximate_neighbors, join_titles, scored_movies, encode_recommendations, recommendations_etag,
+    recommendations_body, batch_results,
+)
+from catalog import MovieCatalog, load_movie_titles_csv, load_movie_titles_couchbase
+from autocomplete import PrefixIndex, TrigramIndex
+from warmup import warmup_titles, save_hot_titles
+from memory import process_memory
+from taste import parse_seeds, parse_ratings, neighbor_arrays, table_arrays, profile_recommendations, rating_recommendations
+import metrics
+import breaker
+from breaker import CircuitOpenError
+import timing
+from timing import span
+import deadline
+from deadline import DeadlineExceeded
+import admission
+import readiness
+from admission import AdmissionController
+from couchbase.exceptions import DocumentNotFoundException
 
 app = Flask(__name__)
+app.logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
 CORS(app)
+metrics.init_app(app)
 
-# CouchDB Connection
-# COUCHDB_URL = os.environ.get("COUCHDB_URL", "http://localhost:5984")
-# DB_NAME = os.environ.get("DB_NAME", "movie_similarities")
-USE_DUMMY_DATA = os.environ.get("USE_DUMMY_DATA", "false").lower() == "true"
-
-dummy_data = {
-    "1": {
-        "similar_movies": [
-            {"movie_id": 2, "avg_score": 0.95},
-            {"movie_id": 3, "avg_score": 0.90},
-            {"movie_id": 4, "avg_score": 0.85},
-        ]
-    },
-    "2": {
-        "similar_movies": [
-            {"movie_id": 1, "avg_score": 0.95},
-            {"movie_id": 3, "avg_score": 0.80},
-            {"movie_id": 4, "avg_score": 0.75},
-        ]
-    },
-}
-
-
-def get_db_connection():
-    # if USE_DUMMY_DATA:
-    return dummy_data
-    # try:
-    #     server = Server(COUCHDB_URL)
-    #     db = server[DB_NAME]
-    #     return db
-    # except Exception as e:
-    #     app.logger.error(f"Database connection error: {e}")
-    #     return None
+# Requests slower than this many seconds are logged with the duration of each phase
+SLOW_REQUEST_THRESHOLD = float(os.environ.get("SLOW_REQUEST_THRESHOLD", "0.5"))
+timing.init_app(app, SLOW_REQUEST_THRESHOLD)
+
+# Every request gets REQUEST_DEADLINE seconds, Couchbase calls are cut short to fit in it
+deadline.init_app(app)
+
+# Requests served at once by a worker, and requests waiting for a slot before new ones are shed with a 503
+MAX_CONCURRENT_REQUESTS = int(os.environ.get("MAX_CONCURRENT_REQUESTS", "64"))
+MAX_QUEUED_REQUESTS = int(os.environ.get("MAX_QUEUED_REQUESTS", "128"))
+# Longest wait for a slot in seconds, also capped by the request deadline
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "0.5"))
+admission_controller = AdmissionController(MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS, ADMISSION_QUEUE_TIMEOUT)
+
+# Encoded recommendation pages keyed by normalised title, offset and k, shared by all requests of a worker
+recommendation_cache = TTLCache(
+    RECOMMENDATION_CACHE_SIZE,
+    RECOMMENDATION_CACHE_TTL,
+    RECOMMENDATION_CACHE_STALE_TTL,
+    negative_ttl=RECOMMENDATION_CACHE_NEGATIVE_TTL,
+)
+metrics.track_cache(recommendation_cache, "recommendations")
+
+# Title indexes, built when the worker starts
+movie_catalog = None
+title_index = None
+title_search = None
+
+
+def unavailable_response(error: CircuitOpenError):
+    """Answer right away while Couchbase is failing, instead of after its timeouts"""
+    response = jsonify({"error": "Service temporarily unavailable"})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(math.ceil(error.retry_after))
+    return response
+
+
+def request_client():
+    """Get the shared Couchbase client, the same one for the whole request so that a
+    connection error resets the client the request actually used"""
+    if not has_request_context():
+        return get_client()
+    client = g.get("couchbase_client")
+    if client is None:
+        client = g.couchbase_client = get_client()
+    return client
+
+
+def reset_request_client() -> None:
+    """Drop the client used by the current request after a connection error, unless another request already replaced it"""
+    client = g.get("couchbase_client") if has_request_context() else None
+    if client is not None:
+        reset_client(client)
+
+
+def request_priority():
+    """Admission priority of the current request: cheap when it is answered from memory, None to always admit it"""
+    endpoint = request.endpoint
+    if endpoint in (None, "health_check", "readiness_check", "get_metrics", "get_stats"):
+        return None
+    try:
+        if endpoint == "get_autosuggestions":
+            if request.args.get("mode") == "search" or title_index is not None:
+                return admission.CHEAP
+        elif endpoint == "get_similar_movies":
+            if USE_DUMMY_DATA or (neighbor_table is not None and request.view_args["movie_id"] in neighbor_table):
+                return admission.CHEAP
+        elif endpoint == "get_recommendations":
+            offset, k = page_params(request.args)
+            if recommendation_cache.contains((normalize_title(request.view_args["movieName"]), offset, k)):
+                return admission.CHEAP
+    except ValueError:
+        # Rejected with a 400 without any lookup
+        return admission.CHEAP
+    return admission.EXPENSIVE
+
+
+admission.init_app(app, admission_controller, request_priority)
+
+
+def get_similar_movies_from_couchbase(movie_id: int, limit: int, offset: int = 0):
+    """Get similar movies from the results collection, or None if the movie has no neighbor list"""
+    try:
+        items, _ = request_client().get_array_slice("results", str(movie_id), "", offset, limit)
+    except DocumentNotFoundException:
+        return None
+    return similar_movies_response(items)
 
 
 @app.route("/similar_movies/<int:movie_id>", methods=["GET"])
 def get_similar_movies(movie_id):
-    db = get_db_connection()
-    if not db:
-        return jsonify({"error": "Database connection failed"}), 500
-
     try:
-        # Assuming movie similarities are stored with movie_id as key
-        doc = dummy_data.get(str(movie_id))
+        offset, k = page_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        if not doc:
-            return jsonify({"error": "Movie not found"}), 404
+    try:
+        # Neighbor lists are stored sorted by similarity score, best first
+        if USE_DUMMY_DATA:
+            doc = dummy_data.get(str(movie_id), {})
+            similar_movies = doc.get("similar_movies", [])[offset:offset + k]
+        elif neighbor_table is not None and movie_id in neighbor_table:
+            similar_movies = neighbor_table.similar_movies(movie_id, k, offset)
+        elif neighbor_table is None or NEIGHBOR_FALLBACK_TO_COUCHBASE:
+            similar_movies = get_similar_movies_from_couchbase(movie_id, k, offset)
+        else:
+            similar_movies = None
 
-        # Retrieve similar movies, sorted by similarity score
-        similar_movies = sorted(
-            doc.get("similar_movies", []), key=lambda x: x["avg_score"], reverse=True
-        )
+        # Movies without a neighbor list get approximate neighbors from the item vectors
+        if similar_movies is None and item_index is not None and movie_id in item_index:
+            with span("ann_search"):
+                similar_movies = item_index.similar_movies(movie_id, k, offset)
 
-        # Optional: Limit to top 10 similar movies
-        similar_movies = similar_movies[:10]
+        if not similar_movies:
+            return jsonify({"error": "Movie not found"}), 404
 
-        return jsonify({"movie_id": movie_id, "similar_movies": similar_movies})
+        with span("encode"):
+            return jsonify({"movie_id": movie_id, "similar_movies": similar_movies})
 
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except CircuitOpenError as e:
+        return unavailable_response(e)
     except Exception as e:
         app.logger.error(f"Error retrieving similar movies: {e}")
+        if is_connection_error(e):
+            reset_request_client()
         return jsonify({"error": "Internal server error"}), 500
 
+
+def approximate_recommendations(movieKey: str, offset: int, k: int):
+    """Get a page of approximate recommendations of a title from the item vectors,
+    or None if the title has no item vector"""
+    with span("title_lookup"):
+        if movie_catalog is not None:
+            movieId = movie_catalog.get_movie_id(movieKey)
+        else:
+            movie_docs = request_client().get_movie_docs_by_name(movieKey)
+            movieId = int(movie_docs[0]["movieId"]) if movie_docs else None
+
+    with span("ann_search"):
+        recommendation_results = approximate_neighbors(movieId, offset, k)
+    if recommendation_results is None:
+        return None
+
+    with span("title_join"):
+        return join_titles(recommendation_results, movie_titles([item["movieId"] for item in recommendation_results]))
+
+
+def fetch_recommendations(movieKey: str, offset: int, k: int):
+    """Fetch a page of recommendations of a title as encoded JSON bytes and a version for the ETag"""
+    recommendation_results, cas = request_client().get_recommendations_with_cas(movieKey, movie_catalog, offset, k)
+    if cas is None:
+        # The movie has no neighbor list, or does not exist
+        if item_index is None:
+            return None
+        recommendation_results = approximate_recommendations(movieKey, offset, k)
+        if recommendation_results is None:
+            return None
+    # A known movie paged past its last recommendation gets an empty page
+    with span("encode"):
+        return encode_recommendations(recommendation_results, cas)
+
+
 @app.route('/get-recommendations-by-name/<string:movieName>', methods=['GET'])
 def get_recommendations(movieName):
     try:
-        cbClient = CouchbaseClient()
-        cbClient.init_app()
-        recommendation_results = []
+        offset, k = page_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        movieKey = normalize_title(movieName)
+
+        # Get the requested page, only one request per title and page goes to Couchbase on a miss
+        cached = recommendation_cache.get_or_load(
+            (movieKey, offset, k), lambda: fetch_recommendations(movieKey, offset, k)
+        )
+        if cached is None:
+            return jsonify({"error": "Movie not found"}), 404
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except CircuitOpenError as e:
+        return unavailable_response(e)
+    except Exception as e:
+        app.logger.error(f"Error retrieving similar movies: {e}")
+        if is_connection_error(e):
+            reset_request_client()
+        return jsonify({"error": "Internal server error"}), 500
+
+    body, version = cached
+    etag = recommendations_etag(version, movieName, offset, k)
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(recommendations_body(movieName, body), mimetype="application/json")
+    response.set_etag(etag)
+    # Browsers keep the response but check with the server before reusing it
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
-        # Get top 10 recommendations from Couchbase
-        # Get movie document by name
-        movie_docs = cbClient.get_movie_docs_by_name(movieName)
-        if (len(movie_docs) > 0):
-            # Get movie document id
-            movie_doc_id = movie_docs[0]['movieId']
 
-            # Get recommendations
-            recommendation_results = cbClient.get_document('results', str(movie_doc_id)).value[:10]
-            movie_ids = [str(item["movieId"]) for item in recommendation_results]
+@app.route('/get-recommendations-batch', methods=['POST'])
+def get_recommendations_batch():
+    try:
+        movieIds, movieNames = parse_batch(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-            # Get movie documents by id
-            movie_docs = cbClient.get_movie_docs_by_id(movie_ids)
+    try:
+        cbClient = request_client()
 
-            # Add movie titles to each document
-            for item in recommendation_results:
-                item['title'] = movie_docs[str(item['movieId'])]
+        # Resolve titles to ids locally when possible, otherwise with a single query
+        if movie_catalog is not None:
+            nameIds = {normalize_title(name): movie_catalog.get_movie_id(name) for name in movieNames}
         else:
-            return jsonify({"error": "Movie not found"}), 404
+            nameIds = cbClient.get_movie_ids_by_names(movieNames) if movieNames else {}
+
+        namedIds = [movieId for movieId in nameIds.values() if movieId is not None]
+        recommendations = cbClient.get_recommendations_batch(movieIds + namedIds, movie_catalog)
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except CircuitOpenError as e:
+        return unavailable_response(e)
     except Exception as e:
-        app.logger.error(f"Error retrieving similar movies: {e}")
+        app.logger.error(f"Error in get_recommendations_batch: {e}")
+        if is_connection_error(e):
+            reset_request_client()
+        return jsonify({"error": "Internal server error"}), 500
+
+    items = batch_results(movieIds, movieNames, nameIds, recommendations, app.logger)
+    with span("encode"):
+        return jsonify({"results": items})
+
+
+def movie_titles(movieIds: list[int]) -> dict:
+    """Get the titles of movies keyed by movie id string, from the catalog when possible"""
+    movieIds = [str(movieId) for movieId in movieIds]
+    if movie_catalog is not None:
+        return movie_catalog.get_titles(movieIds)
+    return request_client().get_movie_docs_by_id(movieIds) if movieIds else {}
+
+
+@app.route('/get-recommendations-profile', methods=['POST'])
+def get_profile_recommendations():
+    body = request.get_json(silent=True) or {}
+    try:
+        seeds = parse_seeds(body.get("seeds"), MAX_BATCH_SIZE)
+        k = body_page_size(body)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        names = [seed["movieName"] for seed in seeds if "movieName" in seed]
+        if movie_catalog is not None:
+            nameIds = {normalize_title(name): movie_catalog.get_movie_id(name) for name in names}
+        else:
+            nameIds = request_client().get_movie_ids_by_names(names) if names else {}
+        for seed in seeds:
+            if "movieName" in seed:
+                seed["movieId"] = nameIds.get(normalize_title(seed["movieName"]))
+        seedIds = list(dict.fromkeys(seed["movieId"] for seed in seeds if seed["movieId"] is not None))
+
+        # Neighbor lists come from the local table when possible, all others from one multi-get
+        neighbor_lists = {}
+        if neighbor_table is not None:
+            for movieId in seedIds:
+                if movieId in neighbor_table:
+                    neighbor_lists[movieId] = table_arrays(neighbor_table, movieId)
+        missing = [movieId for movieId in seedIds if movieId not in neighbor_lists]
+        if missing and (neighbor_table is None or NEIGHBOR_FALLBACK_TO_COUCHBASE):
+            for movieId, neighbors in request_client().get_neighbor_lists(missing).items():
+                neighbor_lists[movieId] = neighbor_arrays(neighbors) if isinstance(neighbors, list) else neighbors
+
+        with span("aggregate"):
+            top = profile_recommendations(seeds, neighbor_lists, k)
+
+        with span("title_join"):
+            recommended = scored_movies(top, movie_titles([movieId for movieId, _ in top]))
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except CircuitOpenError as e:
+        return unavailable_response(e)
+    except Exception as e:
+        app.logger.error(f"Error in get_profile_recommendations: {e}")
+        if is_connection_error(e):
+            reset_request_client()
+        return jsonify({"error": "Internal server error"}), 500
+
+    for seed in seeds:
+        if isinstance(neighbor_lists.get(seed["movieId"]), Exception):
+            app.logger.error(f"Error retrieving neighbors of movie {seed['movieId']}: {neighbor_lists[seed['movieId']]}")
+
+    with span("encode"):
+        return jsonify({"seeds": seeds, "recommendedMovies": recommended})
+
+
+def rating_recommendations_response(ratings: dict, movieIds: list[int], values: list[float], k: int):
+    """Recommend movies for ratings with the in-memory neighbor table, ratings holds the other response fields"""
+    if not movieIds:
+        return jsonify({"error": "No ratings found"}), 404
+    with span("aggregate"):
+        top = rating_recommendations(neighbor_table, movieIds, values, k)
+    with span("title_join"):
+        recommended = scored_movies(top, movie_titles([movieId for movieId, _ in top]))
+    with span("encode"):
+        return jsonify({**ratings, "ratings": len(movieIds), "recommendedMovies": recommended})
+
+
+@app.route('/get-recommendations-for-user/<int:user_id>', methods=['GET'])
+def get_user_recommendations(user_id):
+    try:
+        _, k = page_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if neighbor_table is None:
+        # Thousands of neighbor lists per request are only read from memory
+        return jsonify({"error": "User recommendations are not available"}), 503
+
+    try:
+        movieIds, values = request_client().get_user_ratings(user_id, MAX_USER_RATINGS)
+        return rating_recommendations_response({"userId": user_id}, movieIds, values, k)
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except CircuitOpenError as e:
+        return unavailable_response(e)
+    except Exception as e:
+        app.logger.error(f"Error in get_user_recommendations: {e}")
+        if is_connection_error(e):
+            reset_request_client()
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@app.route('/get-recommendations-for-ratings', methods=['POST'])
+def get_ratings_recommendations():
+    body = request.get_json(silent=True) or {}
+    try:
+        movieIds, values = parse_ratings(body.get("ratings"), MAX_USER_RATINGS)
+        k = body_page_size(body)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    if neighbor_table is None:
+        return jsonify({"error": "User recommendations are not available"}), 503
+
+    try:
+        return rating_recommendations_response({}, movieIds, values, k)
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except CircuitOpenError as e:
+        return unavailable_response(e)
+    except Exception as e:
+        app.logger.error(f"Error in get_ratings_recommendations: {e}")
+        if is_connection_error(e):
+            reset_request_client()
         return jsonify({"error": "Internal server error"}), 500
 
-    # Return the recommended movies in JSON format
-    return jsonify({"movieName": movieName, "recommendedMovies": recommendation_results})
 
 @app.route('/get-autosuggestions/<string:query>', methods=['GET'])
 def get_autosuggestions(query):
-    try:
-        cbClient = CouchbaseClient()
-        cbClient.init_app()
+    # prefix completes the start of titles, search also matches inside titles and tolerates typos
+    mode = request.args.get("mode", "prefix")
+    if mode not in ("prefix", "search"):
+        return jsonify({"error": "mode must be prefix or search"}), 400
+    if mode == "search" and title_search is None:
+        # There is no server-side equivalent, the index is still being built
+        return jsonify({"error": "Title search is not available yet"}), 503
 
-        # Get autosuggestions from Couchbase
-        top_5_movies = cbClient.get_autosuggestion_by_name(query)
+    cbClient = None
+    try:
+        if mode == "search":
+            top_5_movies = title_search.search(query)
+        elif title_index is not None:
+            top_5_movies = title_index.complete(query)
+        else:
+            # Get autosuggestions from Couchbase
+            cbClient = request_client()
+            top_5_movies = cbClient.get_autosuggestion_by_name(query)
 
         # Return suggestions as JSON
         return jsonify({"query": query, "autosuggestions": top_5_movies}), 200
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except CircuitOpenError as e:
+        return unavailable_response(e)
     except Exception as e:
         app.logger.error(f"Error in get_autosuggestions: {e}")  # Add detailed logging
+        if is_connection_error(e):
+            reset_request_client()
         return jsonify({"error": "An error occurred while fetching autosuggestions.", "details": str(e)}), 500
 
+
+def load_movie_titles() -> list[dict]:
+    """Load movie titles from the local titles file, or from Couchbase"""
+    if os.path.exists(MOVIE_TITLES_PATH):
+        return load_movie_titles_csv(MOVIE_TITLES_PATH)
+    return load_movie_titles_couchbase(get_client())
+
+
+def build_title_indexes() -> None:
+    """Build the title to id maps and the autosuggestions index over all movie titles"""
+    global movie_catalog, title_index, title_search
+    start = time.perf_counter()
+    movies = load_movie_titles()
+    movie_catalog = MovieCatalog(movies)
+    title_index = PrefixIndex(movies)
+    title_search = TrigramIndex(movies)
+    app.logger.info(
+        f"Built title indexes over {len(movie_catalog)} movies in "
+        f"{time.perf_counter() - start:.2f}s, autosuggestions index uses {title_index.memory_usage() / 2**20:.1f} MiB, "
+        f"search index uses {title_search.memory_usage() / 2**20:.1f} MiB"
+    )
+
+
+def warm_up_recommendations() -> None:
+    """Load the first page of recommendations of the likely requested titles into the cache"""
+    start = time.perf_counter()
+    titles = warmup_titles(HOT_TITLES_PATH, WARMUP_TITLES_PATH, movie_catalog, WARMUP_TITLES)
+    loaded = 0
+    for title in titles:
+        movieKey = normalize_title(title)
+        # Outside of a request, fetch_recommendations uses the shared client. Failing to
+        # get one ends the warm-up, which warm_up() reports.
+        client = get_client()
+        try:
+            recommendation_cache.get_or_load(
+                (movieKey, 0, DEFAULT_PAGE_SIZE), lambda: fetch_recommendations(movieKey, 0, DEFAULT_PAGE_SIZE)
+            )
+            loaded += 1
+        except Exception as e:
+            app.logger.warning(f"Could not preload recommendations of {title!r}: {e}")
+            if is_connection_error(e):
+                reset_client(client)
+                break
+    app.logger.info(f"Preloaded recommendations of {loaded}/{len(titles)} titles in {time.perf_counter() - start:.2f}s")
+
+
+def preload():
+    """Build the read-only indexes in the gunicorn master, so forked workers share them.
+
+    Only the local titles file is used: Couchbase connections do not survive a
+    fork, so without it each worker builds its own indexes from Couchbase.
+    """
+    if not os.path.exists(MOVIE_TITLES_PATH):
+        app.logger.warning(f"No {MOVIE_TITLES_PATH}, title indexes are built by each worker")
+        return
+    build_title_indexes()
+
+
+def warm_up():
+    """Connect, build the title indexes and fill the caches, then report the worker as ready"""
+    try:
+        get_client()
+    except Exception as e:
+        # The client connects lazily on the next request instead
+        app.logger.warning(f"Could not connect to Couchbase during worker start: {e}")
+
+    # Indexes preloaded in the gunicorn master are inherited
+    if title_index is None:
+        try:
+            build_title_indexes()
+        except Exception as e:
+            # Titles are looked up with N1QL queries instead
+            app.logger.warning(f"Could not build the title indexes: {e}")
+
+    try:
+        warm_up_recommendations()
+    except Exception as e:
+        app.logger.warning(f"Could not preload recommendations: {e}")
+    readiness.mark_ready()
+    app.logger.info(f"Worker ready, memory in bytes: {process_memory()}")
+
+
+def init_worker():
+    """Prepare per-worker state so that the first requests do not pay for it.
+
+    Warm-up runs in the background, the worker answers /health right away and
+    /ready once it is done.
+    """
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+def save_worker_state():
+    """Save the hot titles of this worker for the workers started after it"""
+    try:
+        save_hot_titles(recommendation_cache, HOT_TITLES_PATH, WARMUP_TITLES)
+    except OSError as e:
+        app.logger.warning(f"Could not save the hot titles: {e}")
+
+
+@app.route("/stats", methods=["GET"])
+def get_stats():
+    return jsonify({
+        "recommendation_cache": recommendation_cache.stats(),
+        "movie_catalog": {"movies": len(movie_catalog)} if movie_catalog is not None else None,
+        "autosuggestions_index": title_index.stats() if title_index is not None else None,
+        "search_index": title_search.stats() if title_search is not None else None,
+        "item_index": item_index.stats() if item_index is not None else None,
+        "circuit_breakers": breaker.stats(),
+        "admission": admission_controller.stats(),
+        "memory": process_memory(),
+    }), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    body, content_type = metrics.render()
+    return app.response_class(body, content_type=content_type)
+
+
 @app.route("/health", methods=["GET"])
 def health_check():
     return jsonify({"status": "healthy"}), 200
 
 
+@app.route("/ready", methods=["GET"])
+def readiness_check():
+    # Load balancers route traffic to the container only once all of its workers are warm
+    ready, workers = readiness.status()
+    if not readiness.is_ready():
+        return jsonify({"status": "warming_up", "workers_ready": ready, "workers": workers}), 503
+    return jsonify({"status": "ready", "workers_ready": ready, "workers": workers}), 200
+
+
 if __name__ == "__main__":
+    init_worker()
     app.run(host="0.0.0.0", port=80)
@@ -0,0 +1,458 @@
+# master/asgi.py
+# Asyncio variant of app.py with the same routes and JSON responses, built on the
+# Couchbase SDK's acouchbase API. Run with uvicorn workers instead of gevent:
+#   gunicorn -c gunicorn_asgi.conf.py --worker-class uvicorn.workers.UvicornWorker asgi:app
+import asyncio
+import os
+import time
+from quart import Quart, g, has_request_context, jsonify, request
+from quart_cors import cors
+from couchbase.exceptions import DocumentNotFoundException
+
+from adbconnector import get_client, reset_client
+from dbconnector import is_connection_error, normalize_title
+from cache import AsyncTTLCache
+from service import (
+    USE_DUMMY_DATA, RECOMMENDATION_CACHE_SIZE, RECOMMENDATION_CACHE_TTL, RECOMMENDATION_CACHE_STALE_TTL,
+    RECOMMENDATION_CACHE_NEGATIVE_TTL, NEIGHBOR_FALLBACK_TO_COUCHBASE, neighbor_table, item_index,
+    DEFAULT_PAGE_SIZE, MAX_BATCH_SIZE, MAX_USER_RATINGS, MOVIE_TITLES_PATH, WARMUP_TITLES, WARMUP_TITLES_PATH,
+    HOT_TITLES_PATH, dummy_data, page_params, body_page_size, parse_batch, similar_movies_response,
+    approximate_neighbors, join_titles, scored_movies, encode_recommendations, recommendations_etag,
+    recommendations_body, batch_results,
+)
+from catalog import MovieCatalog, load_movie_titles_csv, load_movie_titles_couchbase_async
+from autocomplete import PrefixIndex, TrigramIndex
+from warmup import warmup_titles, save_hot_titles
+from taste import parse_seeds, parse_ratings, neighbor_arrays, table_arrays, profile_recommendations, rating_recommendations
+import deadline
+import readiness
+from deadline import DeadlineExceeded
+
+app = Quart(__name__)
+app.logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+app = cors(app)
+
+
+# Handlers run in the task of the request, so the deadline is visible to the client
+@app.before_request
+async def start_request_deadline():
+    deadline.start_request()
+
+
+@app.teardown_request
+async def finish_request_deadline(error=None):
+    deadline.finish_request()
+
+
+# Encoded recommendation pages keyed by normalised title, offset and k, shared by all requests of a worker
+recommendation_cache = AsyncTTLCache(
+    RECOMMENDATION_CACHE_SIZE,
+    RECOMMENDATION_CACHE_TTL,
+    RECOMMENDATION_CACHE_STALE_TTL,
+    negative_ttl=RECOMMENDATION_CACHE_NEGATIVE_TTL,
+)
+
+# Title indexes, built when the worker starts
+movie_catalog = None
+title_index = None
+title_search = None
+
+
+async def request_client():
+    """Get the shared Couchbase client, the same one for the whole request so that a
+    connection error resets the client the request actually used"""
+    if not has_request_context():
+        return await get_client()
+    client = g.get("couchbase_client")
+    if client is None:
+        client = g.couchbase_client = await get_client()
+    return client
+
+
+async def reset_request_client() -> None:
+    """Drop the client used by the current request after a connection error, unless another request already replaced it"""
+    client = g.get("couchbase_client") if has_request_context() else None
+    if client is not None:
+        await reset_client(client)
+
+
+async def get_similar_movies_from_couchbase(movie_id: int, limit: int, offset: int = 0) -> list[dict]:
+    """Get similar movies from the results collection, or None if the movie has no neighbor list"""
+    cbClient = await request_client()
+    try:
+        items, _ = await cbClient.get_array_slice("results", str(movie_id), "", offset, limit)
+    except DocumentNotFoundException:
+        return None
+    return similar_movies_response(items)
+
+
+@app.route("/similar_movies/<int:movie_id>", methods=["GET"])
+async def get_similar_movies(movie_id):
+    try:
+        offset, k = page_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        if USE_DUMMY_DATA:
+            doc = dummy_data.get(str(movie_id), {})
+            similar_movies = doc.get("similar_movies", [])[offset:offset + k]
+        elif neighbor_table is not None and movie_id in neighbor_table:
+            similar_movies = neighbor_table.similar_movies(movie_id, k, offset)
+        elif neighbor_table is None or NEIGHBOR_FALLBACK_TO_COUCHBASE:
+            similar_movies = await get_similar_movies_from_couchbase(movie_id, k, offset)
+        else:
+            similar_movies = None
+
+        if similar_movies is None and item_index is not None and movie_id in item_index:
+            similar_movies = item_index.similar_movies(movie_id, k, offset)
+
+        if not similar_movies:
+            return jsonify({"error": "Movie not found"}), 404
+
+        return jsonify({"movie_id": movie_id, "similar_movies": similar_movies})
+
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except Exception as e:
+        app.logger.error(f"Error retrieving similar movies: {e}")
+        if is_connection_error(e):
+            await reset_request_client()
+        return jsonify({"error": "Internal server error"}), 500
+
+
+async def approximate_recommendations(movieKey: str, offset: int, k: int):
+    """Get a page of approximate recommendations of a title from the item vectors,
+    or None if the title has no item vector"""
+    if movie_catalog is not None:
+        movieId = movie_catalog.get_movie_id(movieKey)
+    else:
+        movieId = await (await request_client()).get_movie_id_by_name(movieKey)
+        movieId = int(movieId) if movieId is not None else None
+
+    recommendation_results = approximate_neighbors(movieId, offset, k)
+    if recommendation_results is None:
+        return None
+    return join_titles(recommendation_results, await movie_titles([item["movieId"] for item in recommendation_results]))
+
+
+async def fetch_recommendations(movieKey: str, offset: int, k: int):
+    """Fetch a page of recommendations of a title as encoded JSON bytes and a version for the ETag"""
+    cbClient = await request_client()
+    recommendation_results, cas = await cbClient.get_recommendations_with_cas(movieKey, movie_catalog, offset, k)
+    if cas is None:
+        # The movie has no neighbor list, or does not exist
+        if item_index is None:
+            return None
+        recommendation_results = await approximate_recommendations(movieKey, offset, k)
+        if recommendation_results is None:
+            return None
+    # A known movie paged past its last recommendation gets an empty page
+    return encode_recommendations(recommendation_results, cas)
+
+
+@app.route('/get-recommendations-by-name/<string:movieName>', methods=['GET'])
+async def get_recommendations(movieName):
+    try:
+        offset, k = page_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        movieKey = normalize_title(movieName)
+        cached = await recommendation_cache.get_or_load(
+            (movieKey, offset, k), lambda: fetch_recommendations(movieKey, offset, k)
+        )
+        if cached is None:
+            return jsonify({"error": "Movie not found"}), 404
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except Exception as e:
+        app.logger.error(f"Error retrieving similar movies: {e}")
+        if is_connection_error(e):
+            await reset_request_client()
+        return jsonify({"error": "Internal server error"}), 500
+
+    body, version = cached
+    etag = recommendations_etag(version, movieName, offset, k)
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(b"", status=304)
+    else:
+        response = app.response_class(recommendations_body(movieName, body), mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+@app.route('/get-recommendations-batch', methods=['POST'])
+async def get_recommendations_batch():
+    try:
+        movieIds, movieNames = parse_batch(await request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        cbClient = await request_client()
+
+        if movie_catalog is not None or not movieNames:
+            # Titles are resolved locally, all seeds are fetched together
+            nameIds = {
+                normalize_title(name): movie_catalog.get_movie_id(name) for name in movieNames
+            }
+            namedIds = [movieId for movieId in nameIds.values() if movieId is not None]
+            recommendations = await cbClient.get_recommendations_batch(movieIds + namedIds, movie_catalog)
+        else:
+            # Seeds given by id are fetched while the titles are being resolved
+            nameIds, recommendations = await asyncio.gather(
+                cbClient.get_movie_ids_by_names(movieNames),
+                cbClient.get_recommendations_batch(movieIds, movie_catalog),
+            )
+            namedIds = [movieId for movieId in nameIds.values() if movieId is not None]
+            if namedIds:
+                recommendations.update(await cbClient.get_recommendations_batch(namedIds, movie_catalog))
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except Exception as e:
+        app.logger.error(f"Error in get_recommendations_batch: {e}")
+        if is_connection_error(e):
+            await reset_request_client()
+        return jsonify({"error": "Internal server error"}), 500
+
+    items = batch_results(movieIds, movieNames, nameIds, recommendations, app.logger)
+    return jsonify({"results": items})
+
+
+async def movie_titles(movieIds: list[int]) -> dict:
+    """Get the titles of movies keyed by movie id string, from the catalog when possible"""
+    movieIds = [str(movieId) for movieId in movieIds]
+    if movie_catalog is not None:
+        return movie_catalog.get_titles(movieIds)
+    return await (await request_client()).get_movie_docs_by_id(movieIds) if movieIds else {}
+
+
+@app.route('/get-recommendations-profile', methods=['POST'])
+async def get_profile_recommendations():
+    body = await request.get_json(silent=True) or {}
+    try:
+        seeds = parse_seeds(body.get("seeds"), MAX_BATCH_SIZE)
+        k = body_page_size(body)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        names = [seed["movieName"] for seed in seeds if "movieName" in seed]
+        if movie_catalog is not None:
+            nameIds = {normalize_title(name): movie_catalog.get_movie_id(name) for name in names}
+        else:
+            nameIds = await (await request_client()).get_movie_ids_by_names(names) if names else {}
+        for seed in seeds:
+            if "movieName" in seed:
+                seed["movieId"] = nameIds.get(normalize_title(seed["movieName"]))
+        seedIds = list(dict.fromkeys(seed["movieId"] for seed in seeds if seed["movieId"] is not None))
+
+        neighbor_lists = {}
+        if neighbor_table is not None:
+            for movieId in seedIds:
+                if movieId in neighbor_table:
+                    neighbor_lists[movieId] = table_arrays(neighbor_table, movieId)
+        missing = [movieId for movieId in seedIds if movieId not in neighbor_lists]
+        if missing and (neighbor_table is None or NEIGHBOR_FALLBACK_TO_COUCHBASE):
+            for movieId, neighbors in (await (await request_client()).get_neighbor_lists(missing)).items():
+                neighbor_lists[movieId] = neighbor_arrays(neighbors) if isinstance(neighbors, list) else neighbors
+
+        top = profile_recommendations(seeds, neighbor_lists, k)
+
+        recommended = scored_movies(top, await movie_titles([movieId for movieId, _ in top]))
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except Exception as e:
+        app.logger.error(f"Error in get_profile_recommendations: {e}")
+        if is_connection_error(e):
+            await reset_request_client()
+        return jsonify({"error": "Internal server error"}), 500
+
+    for seed in seeds:
+        if isinstance(neighbor_lists.get(seed["movieId"]), Exception):
+            app.logger.error(f"Error retrieving neighbors of movie {seed['movieId']}: {neighbor_lists[seed['movieId']]}")
+
+    return jsonify({"seeds": seeds, "recommendedMovies": recommended})
+
+
+async def rating_recommendations_response(ratings: dict, movieIds: list[int], values: list[float], k: int):
+    """Recommend movies for ratings with the in-memory neighbor table, ratings holds the other response fields"""
+    if not movieIds:
+        return jsonify({"error": "No ratings found"}), 404
+    top = rating_recommendations(neighbor_table, movieIds, values, k)
+    recommended = scored_movies(top, await movie_titles([movieId for movieId, _ in top]))
+    return jsonify({**ratings, "ratings": len(movieIds), "recommendedMovies": recommended})
+
+
+@app.route('/get-recommendations-for-user/<int:user_id>', methods=['GET'])
+async def get_user_recommendations(user_id):
+    try:
+        _, k = page_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if neighbor_table is None:
+        return jsonify({"error": "User recommendations are not available"}), 503
+
+    try:
+        movieIds, values = await (await request_client()).get_user_ratings(user_id, MAX_USER_RATINGS)
+        return await rating_recommendations_response({"userId": user_id}, movieIds, values, k)
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except Exception as e:
+        app.logger.error(f"Error in get_user_recommendations: {e}")
+        if is_connection_error(e):
+            await reset_request_client()
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@app.route('/get-recommendations-for-ratings', methods=['POST'])
+async def get_ratings_recommendations():
+    body = await request.get_json(silent=True) or {}
+    try:
+        movieIds, values = parse_ratings(body.get("ratings"), MAX_USER_RATINGS)
+        k = body_page_size(body)
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    if neighbor_table is None:
+        return jsonify({"error": "User recommendations are not available"}), 503
+
+    try:
+        return await rating_recommendations_response({}, movieIds, values, k)
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except Exception as e:
+        app.logger.error(f"Error in get_ratings_recommendations: {e}")
+        if is_connection_error(e):
+            await reset_request_client()
+        return jsonify({"error": "Internal server error"}), 500
+
+
+@app.route('/get-autosuggestions/<string:query>', methods=['GET'])
+async def get_autosuggestions(query):
+    mode = request.args.get("mode", "prefix")
+    if mode not in ("prefix", "search"):
+        return jsonify({"error": "mode must be prefix or search"}), 400
+    if mode == "search" and title_search is None:
+        return jsonify({"error": "Title search is not available yet"}), 503
+
+    try:
+        if mode == "search":
+            top_5_movies = title_search.search(query)
+        elif title_index is not None:
+            top_5_movies = title_index.complete(query)
+        else:
+            cbClient = await request_client()
+            top_5_movies = await cbClient.get_autosuggestion_by_name(query)
+
+        return jsonify({"query": query, "autosuggestions": top_5_movies}), 200
+    except DeadlineExceeded:
+        return jsonify({"error": "Request deadline exceeded"}), 504
+    except Exception as e:
+        app.logger.error(f"Error in get_autosuggestions: {e}")
+        if is_connection_error(e):
+            await reset_request_client()
+        return jsonify({"error": "An error occurred while fetching autosuggestions.", "details": str(e)}), 500
+
+
+async def build_title_indexes() -> None:
+    """Build the title to id maps and the autosuggestions index over all movie titles"""
+    global movie_catalog, title_index, title_search
+    start = time.perf_counter()
+    if os.path.exists(MOVIE_TITLES_PATH):
+        movies = load_movie_titles_csv(MOVIE_TITLES_PATH)
+    else:
+        movies = await load_movie_titles_couchbase_async(await get_client())
+    movie_catalog = MovieCatalog(movies)
+    title_index = PrefixIndex(movies)
+    title_search = TrigramIndex(movies)
+    app.logger.info(
+        f"Built title indexes over {len(movie_catalog)} movies in "
+        f"{time.perf_counter() - start:.2f}s, autosuggestions index uses {title_index.memory_usage() / 2**20:.1f} MiB, "
+        f"search index uses {title_search.memory_usage() / 2**20:.1f} MiB"
+    )
+
+
+async def warm_up_recommendations() -> None:
+    """Load the first page of recommendations of the likely requested titles into the cache"""
+    start = time.perf_counter()
+    titles = warmup_titles(HOT_TITLES_PATH, WARMUP_TITLES_PATH, movie_catalog, WARMUP_TITLES)
+
+    async def preload(title: str) -> None:
+        movieKey = normalize_title(title)
+        await recommendation_cache.get_or_load(
+            (movieKey, 0, DEFAULT_PAGE_SIZE), lambda: fetch_recommendations(movieKey, 0, DEFAULT_PAGE_SIZE)
+        )
+
+    results = await asyncio.gather(*(preload(title) for title in titles), return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        app.logger.warning(f"Could not preload recommendations of {len(errors)} titles: {errors[0]}")
+    app.logger.info(
+        f"Preloaded recommendations of {len(titles) - len(errors)}/{len(titles)} titles "
+        f"in {time.perf_counter() - start:.2f}s"
+    )
+
+
+async def warm_up():
+    """Connect, build the title indexes and fill the caches, then report the worker as ready"""
+    try:
+        await get_client()
+    except Exception as e:
+        app.logger.warning(f"Could not connect to Couchbase during worker start: {e}")
+
+    try:
+        await build_title_indexes()
+    except Exception as e:
+        app.logger.warning(f"Could not build the title indexes: {e}")
+
+    try:
+        await warm_up_recommendations()
+    except Exception as e:
+        app.logger.warning(f"Could not preload recommendations: {e}")
+    readiness.mark_ready()
+
+
+@app.before_serving
+async def init_worker():
+    """Prepare per-worker state in the background, /ready reports when it is done"""
+    app.add_background_task(warm_up)
+
+
+@app.after_serving
+async def save_worker_state():
+    """Save the hot titles of this worker for the workers started after it"""
+    try:
+        save_hot_titles(recommendation_cache, HOT_TITLES_PATH, WARMUP_TITLES)
+    except OSError as e:
+        app.logger.warning(f"Could not save the hot titles: {e}")
+
+
+@app.route("/stats", methods=["GET"])
+async def get_stats():
+    return jsonify({
+        "recommendation_cache": recommendation_cache.stats(),
+        "movie_catalog": {"movies": len(movie_catalog)} if movie_catalog is not None else None,
+        "autosuggestions_index": title_index.stats() if title_index is not None else None,
+        "search_index": title_search.stats() if title_search is not None else None,
+        "item_index": item_index.stats() if item_index is not None else None,
+    }), 200
+
+
+@app.route("/health", methods=["GET"])
+async def health_check():
+    return jsonify({"status": "healthy"}), 200
+
+
+@app.route("/ready", methods=["GET"])
+async def readiness_check():
+    ready, workers = readiness.status()
+    if not readiness.is_ready():
+        return jsonify({"status": "warming_up", "workers_ready": ready, "workers": workers}), 503
+    return jsonify({"status": "ready", "workers_ready": ready, "workers": workers}), 200
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=80)
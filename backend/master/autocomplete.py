@@ -0,0 +1,288 @@
+# master/autocomplete.py
+import heapq
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+
+from dbconnector import normalize_title
+
+# Sorts after any character a title can contain, closes the range of keys starting with a prefix
+_PREFIX_END = "\U0010ffff"
+
+_EMPTY_POSTINGS = array("i")
+
+
+def title_popularity(movies: list[dict]) -> dict:
+    """Number of ratings of each distinct title, a title can appear under several movie ids"""
+    popularity = {}
+    for movie in movies:
+        title = movie["title"]
+        popularity[title] = max(popularity.get(title, 0), movie["ratings"])
+    return popularity
+
+
+def trigrams(key: str) -> set:
+    """Distinct character trigrams of a normalised title or query"""
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+def infix_distance(query: str, text: str, max_edits: int) -> int:
+    """Smallest edit distance between query and any substring of text, max_edits + 1 if it is larger"""
+    # Myers' bit-parallel algorithm: bit i of the vertical deltas is column i of
+    # the edit distance matrix, so each character of text is one step of int operations
+    mask = (1 << len(query)) - 1
+    last = 1 << (len(query) - 1)
+    positions = {}
+    for i, char in enumerate(query):
+        positions[char] = positions.get(char, 0) | (1 << i)
+
+    plus, minus, score = mask, 0, len(query)
+    best = score
+    for char in text:
+        equal = positions.get(char, 0)
+        vertical = equal | minus
+        horizontal = ((((equal & plus) + plus) & mask) ^ plus) | equal
+        horizontal_plus = (minus | ~(horizontal | plus)) & mask
+        horizontal_minus = plus & horizontal
+        if horizontal_plus & last:
+            score += 1
+        elif horizontal_minus & last:
+            score -= 1
+        # Nothing is shifted in, a match can start anywhere in text
+        horizontal_plus = (horizontal_plus << 1) & mask
+        horizontal_minus = (horizontal_minus << 1) & mask
+        plus = (horizontal_minus | ~(vertical | horizontal_plus)) & mask
+        minus = horizontal_plus & vertical
+        if score < best:
+            best = score
+    return min(best, max_edits + 1)
+
+
+class PrefixIndex(object):
+    """Prefix completion over movie titles, ranked by popularity.
+
+    Titles are kept as a sorted array of normalised keys, so the titles starting
+    with a prefix form one contiguous range found by binary search. Prefixes that
+    match many titles (the upper levels of the implicit trie) store their top
+    completions, so no query has to rank more than `precompute_threshold` titles.
+    """
+
+    def __init__(self, movies: list[dict], limit: int = 5, precompute_threshold: int = 64) -> None:
+        self.limit = limit
+        self.precompute_threshold = precompute_threshold
+
+        # The same title can appear under several movie ids, keep its most popular entry
+        popularity = title_popularity(movies)
+
+        entries = sorted((normalize_title(title), title) for title in popularity)
+        self.keys = [key for key, _ in entries]
+        self.titles = [title for _, title in entries]
+
+        # Rank 0 is the most popular title, ties are broken alphabetically
+        by_popularity = sorted(range(len(entries)), key=lambda i: (-popularity[self.titles[i]], self.keys[i]))
+        self.ranks = [0] * len(entries)
+        for rank, i in enumerate(by_popularity):
+            self.ranks[i] = rank
+
+        self.top_completions = {}
+        self._precompute_top_completions()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def complete(self, prefix: str, limit: int = None) -> list[str]:
+        """Get the most popular titles starting with prefix"""
+        limit = limit or self.limit
+        key = normalize_title(prefix)
+        if prefix[-1:].isspace() and key:
+            # Keep a trailing space so that "the " only matches whole words
+            key += " "
+        if not key:
+            return []
+
+        if limit <= self.limit:
+            top = self.top_completions.get(key)
+            if top is not None:
+                return top[:limit]
+
+        lo = bisect_left(self.keys, key)
+        hi = bisect_right(self.keys, key + _PREFIX_END, lo)
+        return self._top_titles(lo, hi, limit)
+
+    def memory_usage(self) -> int:
+        """Approximate memory footprint of the index in bytes"""
+        size = sys.getsizeof(self.keys) + sys.getsizeof(self.titles) + sys.getsizeof(self.ranks)
+        size += sum(sys.getsizeof(key) for key in self.keys)
+        size += sum(sys.getsizeof(title) for title in self.titles)
+        size += sum(sys.getsizeof(rank) for rank in self.ranks)
+        size += sys.getsizeof(self.top_completions)
+        for key, top in self.top_completions.items():
+            # Completion lists reference the title strings counted above
+            size += sys.getsizeof(key) + sys.getsizeof(top)
+        return size
+
+    def stats(self) -> dict:
+        return {
+            "titles": len(self.keys),
+            "precomputed_prefixes": len(self.top_completions),
+            "memory_bytes": self.memory_usage(),
+        }
+
+    def _top_titles(self, lo: int, hi: int, limit: int) -> list[str]:
+        top = heapq.nsmallest(limit, range(lo, hi), key=self.ranks.__getitem__)
+        return [self.titles[i] for i in top]
+
+    def _precompute_top_completions(self) -> None:
+        # Walk the implicit trie over the sorted keys, ranges are split on the
+        # character following the common prefix until they become small enough
+        stack = [(0, len(self.keys), 0)]
+        while stack:
+            lo, hi, depth = stack.pop()
+            if hi - lo <= self.precompute_threshold:
+                continue
+            if depth > 0:
+                self.top_completions[self.keys[lo][:depth]] = self._top_titles(lo, hi, self.limit)
+
+            # Keys equal to the common prefix sort first and have no child
+            i = lo
+            while i < hi and len(self.keys[i]) <= depth:
+                i += 1
+            while i < hi:
+                child = self.keys[i][: depth + 1]
+                j = bisect_right(self.keys, child + _PREFIX_END, i, hi)
+                stack.append((i, j, depth + 1))
+                i = j
+
+
+class TrigramIndex(object):
+    """Infix and typo-tolerant search over movie titles, ranked by popularity.
+
+    Titles are numbered in popularity order and every character trigram maps to
+    the sorted ids of the titles containing it. Exact infix matches come from the
+    intersection of the posting lists of the query trigrams. When there are not
+    enough of them, the titles sharing the most trigrams with the query are
+    re-ranked by their edit distance to it, up to `max_candidates` of them.
+    """
+
+    def __init__(self, movies: list[dict], limit: int = 5, max_candidates: int = 16, scan_budget: int = 512) -> None:
+        self.limit = limit
+        self.max_candidates = max_candidates
+        self.scan_budget = scan_budget
+
+        popularity = title_popularity(movies)
+        self.titles = sorted(popularity, key=lambda title: (-popularity[title], normalize_title(title)))
+        self.keys = [normalize_title(title) for title in self.titles]
+
+        postings = {}
+        for title_id, key in enumerate(self.keys):
+            for gram in trigrams(key):
+                postings.setdefault(gram, []).append(title_id)
+        # Ids are appended in increasing order, so every posting list is sorted
+        self.postings = {gram: array("i", ids) for gram, ids in postings.items()}
+        # Trigrams in more titles than this (" (1", "the"...) barely tell titles apart
+        # and are not counted when looking for typos
+        self.max_counted_postings = max(1000, len(self.keys) // 50)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @staticmethod
+    def max_edits(key: str) -> int:
+        """Number of typos tolerated in a query, longer queries tolerate more"""
+        if len(key) < 4:
+            return 0
+        return 1 if len(key) < 9 else 2
+
+    def search(self, query: str, limit: int = None) -> list[str]:
+        """Get the titles containing query, most popular first, then the closest ones with typos"""
+        limit = limit or self.limit
+        key = normalize_title(query)
+        if not key:
+            return []
+        if len(key) < 3:
+            # No trigram to look up, popular titles are scanned first so this stops early
+            matches = []
+            for title_id, title_key in enumerate(self.keys):
+                if key in title_key:
+                    matches.append(title_id)
+                    if len(matches) == limit:
+                        break
+            return [self.titles[title_id] for title_id in matches]
+
+        postings = sorted((self.postings.get(gram, _EMPTY_POSTINGS) for gram in trigrams(key)), key=len)
+        matches = self._infix_matches(key, postings, limit)
+        max_edits = self.max_edits(key)
+        if len(matches) < limit and max_edits > 0:
+            matches += self._fuzzy_matches(key, postings, max_edits, limit - len(matches), set(matches))
+        return [self.titles[title_id] for title_id in matches]
+
+    def memory_usage(self) -> int:
+        """Approximate memory footprint of the index in bytes"""
+        size = sys.getsizeof(self.keys) + sys.getsizeof(self.titles) + sys.getsizeof(self.postings)
+        size += sum(sys.getsizeof(key) for key in self.keys)
+        size += sum(sys.getsizeof(title) for title in self.titles)
+        size += sum(sys.getsizeof(gram) + sys.getsizeof(ids) for gram, ids in self.postings.items())
+        return size
+
+    def stats(self) -> dict:
+        return {
+            "titles": len(self.keys),
+            "trigrams": len(self.postings),
+            "postings": sum(len(ids) for ids in self.postings.values()),
+            "memory_bytes": self.memory_usage(),
+        }
+
+    def _infix_matches(self, key: str, postings: list, limit: int) -> list[int]:
+        # Common queries match many titles: the most popular titles of the
+        # shortest list are checked directly, which usually finds enough of them
+        shortest = postings[0]
+        matches = [title_id for title_id in shortest[:self.scan_budget] if key in self.keys[title_id]]
+        if len(matches) >= limit or len(shortest) <= self.scan_budget:
+            return matches[:limit]
+
+        # Otherwise intersect the rest of the lists, binary searching long lists
+        # while there are few candidates left and merging in C otherwise
+        candidates = set(shortest[self.scan_budget:])
+        for ids in postings[1:]:
+            if not candidates:
+                break
+            if len(candidates) * 16 < len(ids):
+                candidates = {title_id for title_id in candidates if _contains(ids, title_id)}
+            else:
+                candidates.intersection_update(ids)
+
+        # Trigrams can appear in another order, the key itself is checked in popularity order
+        for title_id in sorted(candidates):
+            if key in self.keys[title_id]:
+                matches.append(title_id)
+                if len(matches) == limit:
+                    break
+        return matches
+
+    def _fuzzy_matches(self, key: str, postings: list, max_edits: int, limit: int, exclude: set) -> list[int]:
+        counted = [ids for ids in postings if len(ids) <= self.max_counted_postings]
+        shared = Counter()
+        for ids in counted:
+            shared.update(ids)
+        # An edit changes at most 3 trigrams, so a title within max_edits of the
+        # query shares all but 3 * max_edits of them. Short queries would then
+        # match almost anything, half of the trigrams are required in any case.
+        min_shared = max(len(counted) - 3 * max_edits, (len(counted) + 1) // 2, 1)
+        candidates = [
+            (count, -title_id) for title_id, count in shared.items()
+            if count >= min_shared and title_id not in exclude
+        ]
+
+        # The titles sharing the most trigrams, then the most popular, are checked first
+        ranked = []
+        for _, title_id in heapq.nlargest(self.max_candidates, candidates):
+            distance = infix_distance(key, self.keys[-title_id], max_edits)
+            if distance <= max_edits:
+                ranked.append((distance, -title_id))
+        return [title_id for _, title_id in heapq.nsmallest(limit, ranked)]
+
+
+def _contains(ids: array, title_id: int) -> bool:
+    i = bisect_left(ids, title_id)
+    return i < len(ids) and ids[i] == title_id
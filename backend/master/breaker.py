@@ -0,0 +1,91 @@
+# master/breaker.py
+# Circuit breakers around Couchbase operations. After enough consecutive failures
+# of an operation, calls fail immediately for a while instead of each waiting for
+# the SDK timeouts; then a single trial call decides whether to close the circuit.
+import os
+import threading
+import time
+
+# Consecutive failures of an operation that open its circuit
+FAILURE_THRESHOLD = int(os.environ.get("CB_BREAKER_FAILURES", "5"))
+# Seconds an open circuit rejects calls before letting a trial call through
+RESET_TIMEOUT = float(os.environ.get("CB_BREAKER_RESET_TIMEOUT", "10"))
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an operation whose circuit is open"""
+
+    def __init__(self, operation: str, retry_after: float) -> None:
+        super().__init__(f"Circuit of Couchbase operation {operation} is open")
+        self.operation = operation
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """Closed, open and half-open states of one operation"""
+
+    def __init__(self, operation: str, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT) -> None:
+        self.operation = operation
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.trial_in_flight or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def before_call(self) -> None:
+        """Raise CircuitOpenError unless the operation may be called now"""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            waited = time.monotonic() - self.opened_at
+            if waited >= self.reset_timeout and not self.trial_in_flight:
+                # Half-open: this call is the trial, the others keep failing fast
+                self.trial_in_flight = True
+                return
+            self.rejected += 1
+            retry_after = max(0.0, self.reset_timeout - waited)
+        raise CircuitOpenError(self.operation, retry_after)
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "rejected": self.rejected}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(operation: str) -> CircuitBreaker:
+    """Get the circuit breaker of an operation, creating it on first use"""
+    breaker = _breakers.get(operation)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(operation, CircuitBreaker(operation))
+    return breaker
+
+
+def stats() -> dict:
+    """State of the circuit of every operation called so far"""
+    return {operation: breaker.stats() for operation, breaker in sorted(_breakers.items())}
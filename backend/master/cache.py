@@ -0,0 +1,253 @@
+# master/cache.py
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger("master.cache")
+
+
+class _PendingLoad(object):
+    """Result of a backend fetch that other requests for the same key wait on"""
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class TTLCache(object):
+    """Bounded LRU cache with a time-to-live per entry and per-key request coalescing.
+
+    With a stale_ttl, entries stay usable for that long after they expire: they
+    are still returned right away while a single background load refreshes
+    them, and they keep being returned while that load fails.
+
+    None values, e.g. unknown keys, are kept for negative_ttl only and are never
+    returned stale, so that new data shows up quickly. A negative_ttl of 0 does
+    not cache them at all.
+    """
+
+    def __init__(
+        self, max_size: int = 1024, ttl: float = 300, stale_ttl: float = 0, retry_after: float = 5, negative_ttl: float = None
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        # Delay before a stale entry whose refresh failed is refreshed again
+        self.retry_after = retry_after
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale = 0
+        self.refresh_errors = 0
+        # Optional callable receiving "hit", "miss", "coalesced" or "stale" for every lookup
+        self.on_lookup = None
+        # Optional callable receiving the exception of every failed background refresh
+        self.on_refresh_error = None
+        # key -> (fresh_until, stale_until, value), least recently used first
+        self._entries = OrderedDict()
+        # key -> _PendingLoad for fetches currently in flight
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a cached value, or None if the key is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def contains(self, key) -> bool:
+        """Whether a fresh or stale value of key can be returned without waiting for a load"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def set(self, key, value) -> None:
+        """Store a value, evicting the least recently used entries when full"""
+        with self._lock:
+            self._store(key, value)
+
+    def get_or_load(self, key, loader):
+        """Get a cached value, calling loader() at most once per key on a miss"""
+        found, value, pending, owner = self._claim(key, _PendingLoad)
+        if found:
+            if owner:
+                # Stale entry, refreshed in the background while it is returned
+                threading.Thread(target=self._load, args=(key, loader, pending), daemon=True).start()
+            return value
+        if not owner:
+            return pending.wait()
+
+        self._load(key, loader, pending)
+        return pending.wait()
+
+    def keys(self) -> list:
+        """Keys of the unexpired entries, most recently used first"""
+        now = time.monotonic()
+        with self._lock:
+            return [key for key, (fresh_until, _, _) in reversed(self._entries.items()) if fresh_until > now]
+
+    def clear(self) -> None:
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        """Counters describing the cache effectiveness"""
+        lookups = self.hits + self.misses + self.coalesced + self.stale
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+            "negative_ttl": self.negative_ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "stale": self.stale,
+            "refresh_errors": self.refresh_errors,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+        }
+
+    def _load(self, key, loader, pending: _PendingLoad) -> None:
+        try:
+            pending.value = loader()
+        except Exception as e:
+            pending.error = e
+        self._release(key, pending, pending.error is None, pending.value, pending.error)
+        pending.done.set()
+
+    def _claim(self, key, new_pending):
+        """Look a key up, registering a pending load for it on a miss or a stale hit.
+
+        Returns (found, value, pending, owner), where owner tells whether the
+        caller created the pending load and is responsible for completing it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                result = True, entry[2], None, False
+                outcome = "hit"
+            elif entry is not None and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.stale += 1
+                if key in self._pending:
+                    result = True, entry[2], None, False
+                else:
+                    pending = self._pending[key] = new_pending()
+                    result = True, entry[2], pending, True
+                outcome = "stale"
+            elif key in self._pending:
+                # Another request is already fetching this key, wait for its result
+                self.coalesced += 1
+                result = False, None, self._pending[key], False
+                outcome = "coalesced"
+            else:
+                self.misses += 1
+                pending = self._pending[key] = new_pending()
+                result = False, None, pending, True
+                outcome = "miss"
+
+        if self.on_lookup is not None:
+            self.on_lookup(outcome)
+        return result
+
+    def _release(self, key, pending, succeeded: bool, value, error: Exception = None) -> None:
+        """Complete the bookkeeping of a pending load, caching its value on success"""
+        refresh_failed = False
+        with self._lock:
+            if succeeded:
+                self._store(key, value)
+            else:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] > time.monotonic():
+                    # Keep returning the stale value, and retry the refresh later
+                    # rather than on every lookup while the backend is failing
+                    self.refresh_errors += 1
+                    self._entries[key] = (time.monotonic() + self.retry_after, entry[1], entry[2])
+                    refresh_failed = error is not None
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+
+        # Nobody waits on a background refresh, its failure would go unnoticed otherwise
+        if refresh_failed:
+            logger.warning(f"Refresh of {key!r} failed, serving the stale value: {error!r}")
+            if self.on_refresh_error is not None:
+                self.on_refresh_error(error)
+
+    def _store(self, key, value) -> None:
+        if value is None:
+            if self.negative_ttl <= 0:
+                self._entries.pop(key, None)
+                return
+            fresh_until = time.monotonic() + self.negative_ttl
+            self._entries[key] = (fresh_until, fresh_until, value)
+        else:
+            fresh_until = time.monotonic() + self.ttl
+            self._entries[key] = (fresh_until, fresh_until + self.stale_ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+class AsyncTTLCache(TTLCache):
+    """TTLCache for the asyncio service, where loaders are coroutines"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # Background refreshes, referenced until they finish
+        self._refreshes = set()
+
+    async def get_or_load(self, key, loader):
+        """Get a cached value, awaiting loader() at most once per key on a miss"""
+        found, value, pending, owner = self._claim(key, asyncio.get_running_loop().create_future)
+        if found:
+            if owner:
+                # Stale entry, refreshed in the background while it is returned
+                refresh = asyncio.ensure_future(self._refresh(key, loader, pending))
+                self._refreshes.add(refresh)
+                refresh.add_done_callback(self._refreshes.discard)
+            return value
+        if not owner:
+            # Shielded so that a cancelled waiter does not cancel the shared load
+            return await asyncio.shield(pending)
+        return await self._load(key, loader, pending)
+
+    async def _load(self, key, loader, pending: asyncio.Future):
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            self._release(key, pending, False, None)
+            pending.cancel()
+            raise
+        except Exception as e:
+            self._release(key, pending, False, None, e)
+            pending.set_exception(e)
+            # Mark the exception as retrieved when no other request was waiting for it
+            pending.exception()
+            raise
+        self._release(key, pending, True, value)
+        pending.set_result(value)
+        return value
+
+    async def _refresh(self, key, loader, pending: asyncio.Future) -> None:
+        try:
+            await self._load(key, loader, pending)
+        except Exception:
+            # The stale entry is kept, _release logs and counts the failure
+            pass
@@ -0,0 +1,88 @@
+# master/catalog.py
+import asyncio
+import csv
+import heapq
+
+from dbconnector import normalize_title
+
+
+def load_movie_titles_csv(path: str) -> list[dict]:
+    """Load movie titles and rating counts written by preprocess/movie_titles.py"""
+    with open(path, newline="", encoding="utf-8") as f:
+        return [
+            {
+                "movieId": int(row["movieId"]),
+                "title": row["title"],
+                "ratings": int(row.get("ratings") or 0),
+            }
+            for row in csv.DictReader(f)
+        ]
+
+
+def load_movie_titles_couchbase(client) -> list[dict]:
+    """Load movie titles from the movies collection and rating counts from reviews"""
+    rating_counts = client.get_movie_rating_counts()
+    return [
+        {
+            "movieId": int(movie["movieId"]),
+            "title": movie["title"],
+            "ratings": rating_counts.get(int(movie["movieId"]), 0),
+        }
+        for movie in client.get_all_movie_titles()
+    ]
+
+
+async def load_movie_titles_couchbase_async(client) -> list[dict]:
+    """Load movie titles and rating counts through the asynchronous client"""
+    movies, rating_counts = await asyncio.gather(
+        client.get_all_movie_titles(), client.get_movie_rating_counts()
+    )
+    return [
+        {
+            "movieId": int(movie["movieId"]),
+            "title": movie["title"],
+            "ratings": rating_counts.get(int(movie["movieId"]), 0),
+        }
+        for movie in movies
+    ]
+
+
+class MovieCatalog(object):
+    """In-memory maps between movie ids and titles"""
+
+    def __init__(self, movies: list[dict]) -> None:
+        # movieId -> title
+        self.titles = {}
+        # movieId -> number of ratings
+        self.ratings = {}
+        # normalised title -> movieId, the most rated movie wins when titles collide
+        self.movie_ids = {}
+        ratings = {}
+        for movie in movies:
+            movie_id = movie["movieId"]
+            self.titles[movie_id] = movie["title"]
+            self.ratings[movie_id] = movie["ratings"]
+            key = normalize_title(movie["title"])
+            if key not in self.movie_ids or movie["ratings"] > ratings[key]:
+                self.movie_ids[key] = movie_id
+                ratings[key] = movie["ratings"]
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def get_movie_id(self, title: str):
+        """Get the id of a movie by title, or None if there is no such movie"""
+        return self.movie_ids.get(normalize_title(title))
+
+    def get_titles(self, movie_ids: list) -> dict:
+        """Get movie titles by id, in the format of CouchbaseClient.get_movie_docs_by_id"""
+        return {
+            str(movie_id): self.titles[int(movie_id)]
+            for movie_id in movie_ids
+            if int(movie_id) in self.titles
+        }
+
+    def most_rated_titles(self, limit: int) -> list[str]:
+        """Get the titles of the limit most rated movies, most rated first"""
+        movie_ids = heapq.nlargest(limit, self.ratings, key=self.ratings.get)
+        return [self.titles[movie_id] for movie_id in movie_ids]
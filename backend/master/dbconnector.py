@@ -1,12 +1,42 @@
+import contextvars
 import json
+import os
+import threading
+import time
+from concurrent import futures
+from contextlib import contextmanager
+from types import SimpleNamespace
 from couchbase.cluster import Cluster
-from couchbase.options import ClusterOptions, QueryOptions
+from couchbase.options import (
+    ClusterOptions,
+    ClusterTimeoutOptions,
+    GetAnyReplicaOptions,
+    GetMultiOptions,
+    GetOptions,
+    LookupInOptions,
+    QueryOptions,
+)
 from couchbase.auth import PasswordAuthenticator
-from couchbase.exceptions import CouchbaseException
+from couchbase.exceptions import (
+    AmbiguousTimeoutException,
+    CouchbaseException,
+    DocumentNotFoundException,
+    DocumentUnretrievableException,
+    RequestCanceledException,
+    ServiceUnavailableException,
+    UnAmbiguousTimeoutException,
+)
 from datetime import timedelta
 from couchbase.result import PingResult
 from couchbase.diagnostics import PingState, ServiceType
 from couchbase.management.search import SearchIndex
+import couchbase.subdocument as SD
+import metrics
+from metrics import observe_couchbase
+from breaker import get_breaker
+import deadline
+from deadline import DeadlineExceeded, OPERATION_TIMEOUTS
+from timing import span
 from couchbase.exceptions import QueryIndexAlreadyExistsException
 
 # Hardcoding values for the connection string, username, and password
@@ -14,6 +44,170 @@ DB_CONN_STR="couchbase://dsd1.canadacentral.cloudapp.azure.com,dsd2.canadacentra
 DB_USERNAME="dsdadmin"
 DB_PASSWORD="Dsd@2024"
 
+# Minimum delay between two connection attempts of the shared client, in seconds
+RECONNECT_BACKOFF = float(os.environ.get("CB_RECONNECT_BACKOFF", "1"))
+
+# Collection holding precomputed recommendation responses, written by couchbase-connector/dbimport.py
+RECOMMENDATIONS_COLLECTION = "recommendations"
+
+# Couchbase accepts at most 16 paths in a single sub-document lookup
+MAX_SUBDOC_PATHS = 16
+
+# Opt-in hedged reads of recommendation data: when the active node has not answered
+# within CB_HEDGE_DELAY seconds, a replica is read too. The data only changes on
+# import, so a replica that lags behind is acceptable.
+HEDGED_READS = os.environ.get("CB_HEDGED_READS", "false").lower() == "true"
+HEDGE_DELAY = float(os.environ.get("CB_HEDGE_DELAY", "0.05"))
+# Reads of a worker that can run at once on native threads, as many as the requests it admits
+HEDGE_THREADS = int(os.environ.get("CB_HEDGE_THREADS", os.environ.get("MAX_CONCURRENT_REQUESTS", "64")))
+# Share of those reads that can be hedged at once, extra threads are kept for the replica reads
+HEDGE_MAX_SHARE = float(os.environ.get("CB_HEDGE_MAX_SHARE", "0.1"))
+
+_hedge_pool = None
+_hedge_pool_lock = threading.Lock()
+
+
+class HedgePool(object):
+    """Native threads running the reads of a worker, with a bounded number of hedges.
+
+    The SDK calls block the calling thread, so the reads run on native threads while
+    the request waits. When gevent has patched threading, gevent's pool is used: its
+    threads are native and waiting for its futures yields to the other greenlets.
+    """
+
+    def __init__(self, threads: int, max_share: float) -> None:
+        self.max_hedges = max(1, int(threads * max_share))
+        self.threads = threads + self.max_hedges
+        executor_class, lock_class = futures.ThreadPoolExecutor, threading.Lock
+        try:
+            from gevent import monkey
+            if monkey.is_module_patched("threading"):
+                from gevent.threadpool import ThreadPoolExecutor as executor_class
+                # The counters are updated from the native threads, which cannot use gevent's locks
+                lock_class = monkey.get_original("_thread", "allocate_lock")
+        except ImportError:
+            pass
+        self._executor = executor_class(max_workers=self.threads)
+        self._lock = lock_class()
+        # Reads submitted and not finished yet, and hedged reads among them
+        self.pending = 0
+        self.hedges = 0
+
+    def submit(self, function, *args, hedge: bool = False):
+        """Run function(*args) on a native thread in the context of the caller.
+
+        Returns its future and a list that gets the start time of the call once a
+        thread runs it.
+        """
+        started = []
+        context = contextvars.copy_context()
+
+        def run():
+            started.append(time.monotonic())
+            try:
+                return context.run(function, *args)
+            finally:
+                with self._lock:
+                    self.pending -= 1
+                    if hedge:
+                        self.hedges -= 1
+
+        with self._lock:
+            self.pending += 1
+        return self._executor.submit(run), started
+
+    def reserve_hedge(self) -> bool:
+        """Reserve a hedged read, only when a thread is free and few hedges are in flight"""
+        with self._lock:
+            if self.pending >= self.threads or self.hedges >= self.max_hedges:
+                return False
+            self.hedges += 1
+            return True
+
+
+def hedge_pool() -> HedgePool:
+    """Get the read threads of this process, created on first use so that every forked worker has its own"""
+    global _hedge_pool
+    with _hedge_pool_lock:
+        if _hedge_pool is None:
+            _hedge_pool = HedgePool(HEDGE_THREADS, HEDGE_MAX_SHARE)
+        return _hedge_pool
+
+
+def normalize_title(title: str) -> str:
+    """Normalise a movie title for case and whitespace insensitive lookups"""
+    return " ".join(title.split()).lower()
+
+
+@contextmanager
+def couchbase_operation(operation: str, operation_type: str = None):
+    """Run a Couchbase operation through its circuit breaker, timed for the metrics.
+
+    The yielded object carries the `timeout` to pass to the SDK, what is left of
+    the request deadline when that is shorter than the default of the operation.
+    Raises DeadlineExceeded when the request has no time left, and
+    CircuitOpenError without calling Couchbase while the circuit is open.
+    The operation can set `failed` on the yielded object when it reports
+    failures without raising, e.g. per-key errors of a multi-get.
+    operation_type picks the default timeout, "query" for query: operations and "kv" otherwise.
+    """
+    operation_type = operation_type or ("query" if operation.startswith("query:") else "kv")
+    call = SimpleNamespace(failed=False, timeout=deadline.timeout_for(operation_type))
+    breaker = get_breaker(operation)
+    breaker.before_call()
+    try:
+        with observe_couchbase(operation):
+            yield call
+    except Exception as e:
+        if is_timeout_error(e) and deadline.expired():
+            # The operation was cut short by the request deadline, the cluster is not to blame
+            raise DeadlineExceeded(f"Request deadline exceeded during {operation}") from e
+        # Missing documents and invalid queries are answers, not an unavailable cluster
+        call.failed = is_unavailable_error(e)
+        raise
+    finally:
+        if call.failed:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+
+
+def array_slice_specs(path: str, offset: int, k: int) -> list[list]:
+    """Sub-document get specs of the elements [offset, offset + k) of an array,
+    grouped in lookups of at most MAX_SUBDOC_PATHS paths"""
+    indexes = list(range(offset, offset + k))
+    return [
+        [SD.get(f"{path}[{index}]") for index in indexes[start:start + MAX_SUBDOC_PATHS]]
+        for start in range(0, len(indexes), MAX_SUBDOC_PATHS)
+    ]
+
+
+def array_slice_values(lookup_result) -> tuple[list, bool]:
+    """Elements found by a lookup of array_slice_specs, and whether the array ended before the last path"""
+    values = []
+    for index in range(len(lookup_result.value)):
+        if not lookup_result.exists(index):
+            return values, True
+        values.append(lookup_result.content_as[dict](index))
+    return values, False
+
+
+def replica_array_slice(value, path: str, offset: int, k: int) -> list:
+    """Elements [offset, offset + k) of an array read from a whole replica document"""
+    array = value[path] if path else value
+    return array[offset:offset + k]
+
+
+def recommendation_key_by_id(movie_id) -> str:
+    """Key of the precomputed recommendations document of a movie id"""
+    return f"id::{movie_id}"
+
+
+def recommendation_key_by_title(title: str) -> str:
+    """Key of the precomputed recommendations document of a movie title"""
+    return f"title::{normalize_title(title)}"
+
+
 class CouchbaseClient(object):
     """Class to handle interactions with Couchbase cluster"""
 
@@ -21,6 +215,7 @@ class CouchbaseClient(object):
         self.cluster = None
         self.bucket = None
         self.scope = None
+        self.collection_names = set()
 
     def init_app(self):
         """Initialize connection to the Couchbase cluster"""
@@ -39,15 +234,20 @@ class CouchbaseClient(object):
                 # authentication for Couchbase cluster
                 auth = PasswordAuthenticator(self.username, self.password)
 
-                cluster_opts = ClusterOptions(auth)
-                # wan_development is used to avoid latency issues while connecting to Couchbase over the internet
-                cluster_opts.apply_profile("wan_development")
+                # Operations pass their own timeouts, bounded by the request deadline,
+                # these defaults only apply to calls made outside of a request
+                timeout_opts = ClusterTimeoutOptions(
+                    connect_timeout=timedelta(seconds=OPERATION_TIMEOUTS["connect"]),
+                    kv_timeout=timedelta(seconds=OPERATION_TIMEOUTS["kv"]),
+                    query_timeout=timedelta(seconds=OPERATION_TIMEOUTS["query"]),
+                )
+                cluster_opts = ClusterOptions(auth, timeout_options=timeout_opts)
 
                 # connect to the cluster
                 self.cluster = Cluster(self.conn_str, cluster_opts)
 
                 # wait until the cluster is ready for use
-                self.cluster.wait_until_ready(timedelta(seconds=5))
+                self.cluster.wait_until_ready(deadline.timeout_for("connect"))
 
                 # get a reference to our bucket
                 self.bucket = self.cluster.bucket(self.bucket_name)
@@ -56,13 +256,15 @@ class CouchbaseClient(object):
                 print(
                     "Ensure that you have the recommender bucket loaded in the cluster."
                 )
-                exit()
+                self.close()
+                raise
 
             if not self.check_scope_exists():
                 print(
                     "Inventory scope does not exist in the bucket. \nEnsure that you have the inventory scope in your recommender bucket."
                 )
-                exit()
+                self.close()
+                raise RuntimeError(f"Scope '{self.scope_name}' does not exist in bucket '{self.bucket_name}'")
 
             # get a reference to our scope
             self.scope = self.bucket.scope(self.scope_name)
@@ -78,16 +280,33 @@ class CouchbaseClient(object):
     def check_scope_exists(self) -> bool:
         """Check if the scope exists in the bucket"""
         try:
-            scopes_in_bucket = [
-                scope.name for scope in self.bucket.collections().get_all_scopes()
-            ]
-            return self.scope_name in scopes_in_bucket
+            scopes_in_bucket = {
+                scope.name: scope for scope in self.bucket.collections().get_all_scopes()
+            }
+            if self.scope_name not in scopes_in_bucket:
+                return False
+            # remember the collections so optional ones can be skipped without a round trip
+            self.collection_names = {
+                collection.name for collection in scopes_in_bucket[self.scope_name].collections
+            }
+            return True
         except Exception as e:
             print(
                 "Error fetching scopes in cluster. \nEnsure that recommender bucket exists."
             )
             print(e)
-            exit()
+            raise
+
+    def close(self) -> None:
+        """Close the connection to the Couchbase cluster"""
+        cluster, self.cluster = self.cluster, None
+        self.bucket = None
+        self.scope = None
+        if cluster:
+            try:
+                cluster.close()
+            except Exception as e:
+                print(f"Error closing cluster connection: {e}")
 
     def is_search_service_enabled(self, min_nodes: int = 1) -> bool:
         try:
@@ -121,7 +340,93 @@ class CouchbaseClient(object):
 
     def get_document(self, collection_name: str, key: str):
         """Get document by key using KV operation"""
-        return self.scope.collection(collection_name).get(key)
+        with couchbase_operation("get_document") as call:
+            return self.scope.collection(collection_name).get(key, GetOptions(timeout=call.timeout))
+
+    def get_documents(self, collection_name: str, keys: list[str]) -> tuple[dict, dict]:
+        """Get many documents in one round trip, returns values and errors by key"""
+        if not keys:
+            return {}, {}
+        with couchbase_operation("get_documents") as call:
+            multi_res = self.scope.collection(collection_name).get_multi(keys, GetMultiOptions(timeout=call.timeout))
+            call.failed = any(is_unavailable_error(e) for e in multi_res.exceptions.values())
+        values = {key: res.value for key, res in multi_res.results.items()}
+        return values, multi_res.exceptions
+
+    def get_array_slice(self, collection_name: str, key: str, path: str, offset: int, k: int) -> tuple[list, int]:
+        """Get the elements [offset, offset + k) of an array in a document and the document CAS,
+        hedged with a replica read when the primary is slow and hedged reads are enabled.
+
+        Only the requested elements are sent by the server. path is the array, an
+        empty path is a document that is an array itself.
+        """
+        if not HEDGED_READS:
+            return self._lookup_array_slice(collection_name, key, path, offset, k)
+
+        pool = hedge_pool()
+        stop = []
+        primary, started = pool.submit(self._lookup_array_slice, collection_name, key, path, offset, k, stop)
+        # The hedge delay runs from the start of the primary read: a read waiting for a
+        # thread is not slow, and a replica read would only wait behind it
+        while True:
+            waited = time.monotonic() - started[0] if started else 0.0
+            done, _ = futures.wait([primary], timeout=max(HEDGE_DELAY - waited, 0))
+            if done:
+                if primary.exception() is None:
+                    metrics.HEDGED_READS.labels("primary").inc()
+                return primary.result()
+            if started and time.monotonic() - started[0] >= HEDGE_DELAY:
+                break
+
+        if not pool.reserve_hedge():
+            # Every thread is busy or enough reads are hedged already, doubling this one would add to the load
+            metrics.HEDGED_READS.labels("skipped").inc()
+            return primary.result()
+
+        replica, _ = pool.submit(self.get_array_slice_from_replica, collection_name, key, path, offset, k, hedge=True)
+        reads = {primary: "primary_after_hedge", replica: "replica"}
+        try:
+            # Both reads are bounded by the request deadline, so waiting has no timeout of its own
+            while reads:
+                done, _ = futures.wait(reads, return_when=futures.FIRST_COMPLETED)
+                for read in done:
+                    outcome = reads.pop(read)
+                    # A failed read only matters when the other one fails too
+                    if read.exception() is None or not reads:
+                        metrics.HEDGED_READS.labels(outcome if read.exception() is None else "failed").inc()
+                        return read.result()
+        finally:
+            # The losing read cannot be interrupted, but it is dropped if it has not started
+            # yet and the primary read stops before its next lookup
+            stop.append(True)
+            for read in reads:
+                read.cancel()
+
+    def get_array_slice_from_replica(self, collection_name: str, key: str, path: str, offset: int, k: int) -> tuple[list, int]:
+        """Get the elements [offset, offset + k) of an array from whichever copy of a document answers first"""
+        try:
+            with couchbase_operation("get_any_replica") as call:
+                res = self.scope.collection(collection_name).get_any_replica(key, GetAnyReplicaOptions(timeout=call.timeout))
+        except DocumentUnretrievableException as e:
+            # No copy has the document, the same answer as a primary read of a missing document
+            raise DocumentNotFoundException(message=f"No replica of {key} found") from e
+        return replica_array_slice(res.value, path, offset, k), res.cas
+
+    def _lookup_array_slice(self, collection_name: str, key: str, path: str, offset: int, k: int, stop=()) -> tuple[list, int]:
+        """Read the slice with sub-document lookups, giving up before the next lookup
+        once stop is non-empty because another read has answered"""
+        values, cas = [], None
+        for specs in array_slice_specs(path, offset, k):
+            if stop:
+                break
+            with couchbase_operation("lookup_in") as call:
+                res = self.scope.collection(collection_name).lookup_in(key, specs, LookupInOptions(timeout=call.timeout))
+            cas = cas or res.cas
+            found, ended = array_slice_values(res)
+            values += found
+            if ended:
+                break
+        return values, cas
 
     def insert_document(self, collection_name: str, key: str, doc: dict):
         """Insert document using KV operation"""
@@ -135,53 +440,218 @@ class CouchbaseClient(object):
         """Upsert document using KV operation"""
         return self.scope.collection(collection_name).upsert(key, doc)
 
-    def query(self, sql_query, *options, **kwargs):
-        """Query Couchbase using SQL++"""
+    def query(self, sql_query, *options, statement_name: str = "adhoc", timeout_type: str = "query", **kwargs) -> list:
+        """Query Couchbase using SQL++ and collect all rows"""
         # options are used for positional parameters
         # kwargs are used for named parameters
-        return self.scope.query(sql_query, *options, **kwargs)
+        # rows are streamed lazily, so they are collected here for the timing to cover the whole query
+        with couchbase_operation(f"query:{statement_name}", timeout_type) as call:
+            return list(self.scope.query(sql_query, *options, timeout=call.timeout, **kwargs))
 
     def get_autosuggestion_by_name(self, query_name: str, limit:int=5) -> list[str]:
         """Get top autosuggestion movie names by name"""
         q_str = 'SELECT t.title FROM `movies` t WHERE LOWER(t.title) LIKE $title LIMIT $limit;'
-        q_res = self.query(q_str, QueryOptions(named_parameters={'title': query_name.lower()+'%', 'limit':limit}))
+        q_res = self.query(q_str, QueryOptions(named_parameters={'title': query_name.lower()+'%', 'limit':limit}), statement_name='autosuggestion_by_name')
         results = list(map(lambda x: x['title'],list(q_res)))
         return results
 
+    def get_all_movie_titles(self) -> list[dict]:
+        """Get the id and title of every movie"""
+        q_str = 'SELECT t.movieId, t.title FROM `movies` t;'
+        return self.query(q_str, statement_name='all_movie_titles', timeout_type='bulk_query')
+
+    def get_movie_rating_counts(self) -> dict:
+        """Get the number of reviews of each movie"""
+        q_str = 'SELECT r.movieId, COUNT(1) AS ratings FROM `reviews` r GROUP BY r.movieId;'
+        return {int(item['movieId']): item['ratings'] for item in self.query(q_str, statement_name='movie_rating_counts', timeout_type='bulk_query')}
+
+    def get_user_ratings(self, user_id: int, limit: int) -> tuple[list[int], list[float]]:
+        """Get the ids of the movies rated by a user and the ratings, at most limit of them.
+
+        Covered by the idx_reviews_user_ratings index created by couchbase-connector/dbimport.py.
+        """
+        q_str = 'SELECT r.movieId, r.rating FROM `reviews` r WHERE r.userId = $user_id LIMIT $limit;'
+        q_res = self.query(q_str, QueryOptions(named_parameters={'user_id': user_id, 'limit': limit}), statement_name='user_ratings')
+        return [int(item['movieId']) for item in q_res], [float(item['rating']) for item in q_res]
+
     def get_reviews_in_chunk(self, size:int=100, offset:int=0) -> list[dict]:
         """Get reviews in chunks"""
         q_str = 'SELECT r.movieId, r.rating, r.title, r.userId FROM `reviews` r LIMIT $size OFFSET $offset;'
-        q_res = self.query(q_str, QueryOptions(named_parameters={'size': size, 'offset':offset}))
+        q_res = self.query(q_str, QueryOptions(named_parameters={'size': size, 'offset':offset}), statement_name='reviews_in_chunk')
         results = list(q_res)
         return results
 
     def get_movie_docs_by_name(self, name:str) -> dict:
         """Get movie document by name"""
         q_str = 'SELECT t.* FROM `movies` t WHERE LOWER(t.title) = $title;'
-        q_res = self.query(q_str, QueryOptions(named_parameters={'title': name.lower()}))
+        q_res = self.query(q_str, QueryOptions(named_parameters={'title': name.lower()}), statement_name='movie_docs_by_name')
         results = list(q_res)
         return results
 
     def get_movie_docs_by_id(self, movie_ids:list[int]) -> dict:
         """Get movie document by id"""
         q_str = 'SELECT META().id, t.title FROM `movies` t WHERE META().id IN $movie_ids;'
-        q_res = self.query(q_str, QueryOptions(named_parameters={'movie_ids': movie_ids}))
+        q_res = self.query(q_str, QueryOptions(named_parameters={'movie_ids': movie_ids}), statement_name='movie_docs_by_id')
         list_results = list(q_res)
         results = {item['id']: item['title'] for item in list_results}
         return results
 
-    def get_recommendations(self, movieName: str) -> list[dict]:
-        # Return the recommended movies in JSON format
-        movie_docs = self.get_movie_docs_by_name(movieName)
-        if (len(movie_docs) > 0):
-            movie_doc_id = movie_docs[0]['movieId']
+    def get_movie_ids_by_names(self, names: list[str]) -> dict:
+        """Get movie ids by normalised title, in a single query"""
+        q_str = 'SELECT t.movieId, LOWER(t.title) AS title FROM `movies` t WHERE LOWER(t.title) IN $titles;'
+        q_res = self.query(q_str, QueryOptions(named_parameters={'titles': [normalize_title(name) for name in names]}), statement_name='movie_ids_by_names')
+        return {normalize_title(item['title']): item['movieId'] for item in q_res}
+
+    def get_precomputed_recommendations(self, movieName: str, offset: int = 0, k: int = 10):
+        """Get a page of the recommendations document written by dbimport.py and its CAS,
+        or None if there is no such document"""
+        if RECOMMENDATIONS_COLLECTION not in self.collection_names:
+            return None
+        try:
+            return self.get_array_slice(
+                RECOMMENDATIONS_COLLECTION, recommendation_key_by_title(movieName), "recommendedMovies", offset, k
+            )
+        except DocumentNotFoundException:
+            return None
+
+    def get_recommendations(self, movieName: str, catalog=None, offset: int = 0, k: int = 10) -> list[dict]:
+        return self.get_recommendations_with_cas(movieName, catalog, offset, k)[0]
 
-            recommendation_results = self.get_document('results', str(movie_doc_id)).value[:10]
-            movie_ids = [str(item["movieId"]) for item in recommendation_results]
+    def get_recommendations_with_cas(self, movieName: str, catalog=None, offset: int = 0, k: int = 10) -> tuple[list[dict], int]:
+        """Get the recommendations [offset, offset + k) and the CAS of the document they were read from,
+        the CAS is None when the movie or its neighbor list does not exist"""
+        # Precomputed documents already embed titles, a single sub-document lookup is enough.
+        # They only hold the best recommendations, the rest of a page is in the neighbor list.
+        page = self.get_precomputed_recommendations(movieName, offset, k)
+        if page is not None and len(page[0]) == k:
+            return page
 
-            movie_docs = self.get_movie_docs_by_id(movie_ids)
+        # Resolve titles from the in-memory catalog when there is one, otherwise with N1QL
+        with span("title_lookup"):
+            if catalog is not None:
+                movie_doc_id = catalog.get_movie_id(movieName)
+            else:
+                movie_docs = self.get_movie_docs_by_name(movieName)
+                movie_doc_id = movie_docs[0]['movieId'] if len(movie_docs) > 0 else None
+
+        if movie_doc_id is None:
+            return page or ([], None)
+
+        # Only the requested page of the neighbor list is read
+        try:
+            recommendation_results, cas = self.get_array_slice('results', str(movie_doc_id), "", offset, k)
+        except DocumentNotFoundException:
+            # Movies dropped by the per-partition top-100 have no neighbor list
+            return page or ([], None)
+        movie_ids = [str(item["movieId"]) for item in recommendation_results]
+
+        with span("title_join"):
+            if catalog is not None:
+                movie_docs = catalog.get_titles(movie_ids)
+            else:
+                movie_docs = self.get_movie_docs_by_id(movie_ids) if movie_ids else {}
             for item in recommendation_results:
-                item['title'] = movie_docs[str(item['movieId'])]
-            return recommendation_results
-        else:
-            return []
+                item['title'] = movie_docs.get(str(item['movieId']))
+        return recommendation_results, cas
+
+    def get_neighbor_lists(self, movie_ids: list[int]) -> dict:
+        """Get the whole neighbor lists of many movies from the results collection with one multi-get.
+
+        Returns a dict from movie id to its list of {"movieId", "avg_score"}, None when
+        the movie has no results document, or the exception raised while fetching it.
+        """
+        keys = list(dict.fromkeys(str(movie_id) for movie_id in movie_ids))
+        values, errors = self.get_documents('results', keys)
+
+        neighbor_lists = {}
+        for key in keys:
+            if key in values:
+                neighbor_lists[int(key)] = values[key]
+            elif isinstance(errors.get(key), DocumentNotFoundException) or key not in errors:
+                neighbor_lists[int(key)] = None
+            else:
+                neighbor_lists[int(key)] = errors[key]
+        return neighbor_lists
+
+    def get_recommendations_batch(self, movie_ids: list[int], catalog=None, limit: int = 10) -> dict:
+        """Get recommendations of many movies with one multi-get and one title lookup.
+
+        Returns a dict from movie id to its recommendations, None when the movie has
+        no results document, or the exception raised while fetching it.
+        """
+        recommendations = {
+            movie_id: [dict(item) for item in neighbors[:limit]] if isinstance(neighbors, list) else neighbors
+            for movie_id, neighbors in self.get_neighbor_lists(movie_ids).items()
+        }
+
+        # Resolve the titles of all recommended movies at once
+        neighbor_ids = list({
+            str(item['movieId'])
+            for items in recommendations.values() if isinstance(items, list)
+            for item in items
+        })
+        with span("title_join"):
+            if catalog is not None:
+                movie_docs = catalog.get_titles(neighbor_ids)
+            else:
+                movie_docs = self.get_movie_docs_by_id(neighbor_ids) if neighbor_ids else {}
+            for items in recommendations.values():
+                if isinstance(items, list):
+                    for item in items:
+                        item['title'] = movie_docs.get(str(item['movieId']))
+        return recommendations
+
+
+# One client per worker process, shared by all requests (and greenlets) of that worker
+_shared_client = None
+_shared_client_lock = threading.Lock()
+_last_connect_failure = 0.0
+
+
+def get_client() -> CouchbaseClient:
+    """Return the shared Couchbase client, connecting on first use"""
+    global _shared_client, _last_connect_failure
+    client = _shared_client
+    if client is not None:
+        return client
+
+    # threading.Lock is patched by gevent, so waiting greenlets yield while one of them connects
+    with _shared_client_lock:
+        if _shared_client is not None:
+            return _shared_client
+        if time.monotonic() - _last_connect_failure < RECONNECT_BACKOFF:
+            raise RuntimeError("Couchbase cluster is unavailable, retrying connection later")
+        client = CouchbaseClient()
+        try:
+            with observe_couchbase("connect"):
+                client.init_app()
+        except Exception:
+            _last_connect_failure = time.monotonic()
+            raise
+        _shared_client = client
+        return client
+
+
+def reset_client(client: CouchbaseClient = None) -> None:
+    """Drop the shared client so that the next get_client() call reconnects"""
+    global _shared_client
+    with _shared_client_lock:
+        # Another request may already have replaced a broken client
+        if _shared_client is None or (client is not None and client is not _shared_client):
+            return
+        client, _shared_client = _shared_client, None
+    client.close()
+
+
+def is_connection_error(error: Exception) -> bool:
+    """Whether an error means the shared client has lost its connection"""
+    return isinstance(error, (ServiceUnavailableException, RequestCanceledException))
+
+
+def is_timeout_error(error: Exception) -> bool:
+    return isinstance(error, (AmbiguousTimeoutException, UnAmbiguousTimeoutException))
+
+
+def is_unavailable_error(error: Exception) -> bool:
+    """Whether an error means the cluster did not answer in time, counted by the circuit breakers"""
+    return is_connection_error(error) or is_timeout_error(error)
@@ -0,0 +1,71 @@
+# master/deadline.py
+# End-to-end request deadlines. The deadline of the current request is kept in a
+# context variable, like the timing spans, and every Couchbase call gets the
+# smaller of its own timeout and the time left to the request.
+import os
+import time
+from contextvars import ContextVar
+from datetime import timedelta
+
+# Time budget of a whole request, in seconds
+REQUEST_DEADLINE = float(os.environ.get("REQUEST_DEADLINE", "3"))
+# Default timeouts of each type of Couchbase operation, in seconds
+OPERATION_TIMEOUTS = {
+    "connect": float(os.environ.get("CB_CONNECT_TIMEOUT", "5")),
+    "kv": float(os.environ.get("CB_KV_TIMEOUT", "1")),
+    "query": float(os.environ.get("CB_QUERY_TIMEOUT", "2.5")),
+    # Queries over whole collections, run when a worker starts rather than during a request
+    "bulk_query": float(os.environ.get("CB_BULK_QUERY_TIMEOUT", "60")),
+}
+
+_deadline = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the time budget of the current request has run out"""
+
+
+def start_request(budget: float = REQUEST_DEADLINE) -> None:
+    """Give the current request budget seconds to complete"""
+    _deadline.set(time.monotonic() + budget)
+
+
+def finish_request() -> None:
+    _deadline.set(None)
+
+
+def remaining():
+    """Seconds left to the current request, or None outside of a request"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def timeout_for(operation_type: str) -> timedelta:
+    """Timeout of the next operation of a type: its default, capped by the time left to the request.
+
+    Raises DeadlineExceeded rather than starting an operation without any time left.
+    """
+    timeout = OPERATION_TIMEOUTS[operation_type]
+    left = remaining()
+    if left is not None:
+        if left <= 0:
+            raise DeadlineExceeded(f"Request deadline exceeded before a {operation_type} operation")
+        timeout = min(timeout, left)
+    return timedelta(seconds=timeout)
+
+
+def init_app(app, budget: float = REQUEST_DEADLINE) -> None:
+    """Give every request of a Flask app budget seconds to complete"""
+
+    @app.before_request
+    def start_request_deadline():
+        start_request(budget)
+
+    @app.teardown_request
+    def finish_request_deadline(error=None):
+        finish_request()
@@ -0,0 +1,65 @@
+# master/gunicorn.conf.py
+# Picked up automatically by gunicorn from the working directory; the
+# command line flags in the Dockerfile still take precedence over settings here.
+import gc
+import os
+import shutil
+
+# Load the app in the master so that the read-only indexes are built once and
+# shared copy-on-write by the forked workers
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false").lower() == "true"
+
+if preload_app and os.environ.get("GUNICORN_WORKER_CLASS") == "gevent":
+    # The workers would only be patched after the app has created its locks
+    from gevent import monkey
+
+    monkey.patch_all()
+
+
+def on_starting(server):
+    # Metric files of a previous run would be aggregated with the new workers
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir, exist_ok=True)
+    # Markers of the workers of a previous run would report the new ones as ready
+    import readiness
+
+    readiness.clear()
+
+
+def when_ready(server):
+    # Runs in the master once the app is loaded, before the first worker is forked
+    if not preload_app:
+        return
+    import app
+
+    app.preload()
+    # Move everything allocated so far out of the collector's reach: collections
+    # in the workers would otherwise write to the headers of these objects and
+    # copy the pages holding them
+    gc.collect()
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    # Runs in each worker after the app is loaded (and after gevent has
+    # patched the worker), before it accepts its first connection
+    import app
+
+    app.init_worker()
+
+
+def worker_exit(server, worker):
+    # Runs in the worker, the next workers preload the titles it served most recently
+    import app
+
+    app.save_worker_state()
+
+
+def child_exit(server, worker):
+    import metrics
+    import readiness
+
+    metrics.mark_process_dead(worker.pid)
+    readiness.mark_exited(worker.pid)
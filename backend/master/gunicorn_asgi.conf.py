@@ -0,0 +1,26 @@
+# master/gunicorn_asgi.conf.py
+# Configuration of the asyncio variant, passed with -c so that gunicorn.conf.py,
+# whose hooks load the Flask app, is not picked up. asgi.py prepares and saves
+# the state of each worker in its own serving hooks.
+import os
+import shutil
+
+
+def on_starting(server):
+    # Metric files of a previous run would be aggregated with the new workers
+    multiproc_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir, exist_ok=True)
+    # Markers of the workers of a previous run would report the new ones as ready
+    import readiness
+
+    readiness.clear()
+
+
+def child_exit(server, worker):
+    import metrics
+    import readiness
+
+    metrics.mark_process_dead(worker.pid)
+    readiness.mark_exited(worker.pid)
@@ -0,0 +1,86 @@
+# master/item_index.py
+# Approximate nearest neighbors of movies without precomputed neighbors, from the
+# clustered item vectors written by preprocess/item_index.py (an inverted file index).
+import numpy as np
+
+ITEM_INDEX_VERSION = 1
+
+
+class ItemIndex(object):
+    """Read-only inverted file index over unit-length movie vectors"""
+
+    def __init__(self, path: str, probes: int = 16) -> None:
+        with np.load(path) as data:
+            if int(data["version"]) != ITEM_INDEX_VERSION:
+                raise ValueError(f"{path} is not a version {ITEM_INDEX_VERSION} item index")
+            self.path = path
+            # Rows are grouped by cluster, the rows of cluster c are list_offsets[c] to list_offsets[c + 1]
+            self.movie_ids = data["movie_ids"]
+            self.vectors = data["vectors"]
+            self.list_offsets = data["list_offsets"]
+            self.centroids = data["centroids"]
+            # Movie ids in increasing order and their rows
+            self.sorted_ids = data["sorted_ids"]
+            self.sorted_rows = data["sorted_rows"]
+        # Number of clusters closest to a movie that are searched, more is slower but more accurate
+        self.probes = min(probes, len(self.centroids))
+
+    def __len__(self) -> int:
+        return len(self.movie_ids)
+
+    def __contains__(self, movie_id: int) -> bool:
+        return self._row(movie_id) is not None
+
+    def neighbors(self, movie_id: int, limit: int, offset: int = 0) -> tuple:
+        """Get the ids and cosine similarities of the approximate nearest neighbors of a movie,
+        best first, skipping the offset best ones"""
+        row = self._row(movie_id)
+        if row is None:
+            return self.movie_ids[0:0], np.empty(0, dtype=np.float32)
+
+        query = self.vectors[row]
+        clusters = np.argpartition(-(self.centroids @ query), self.probes - 1)[:self.probes]
+        rows, scores = [], []
+        for cluster in clusters:
+            start, end = self.list_offsets[cluster], self.list_offsets[cluster + 1]
+            rows.append(np.arange(start, end))
+            scores.append(self.vectors[start:end] @ query)
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        scores[rows == row] = -np.inf
+
+        needed = min(offset + limit, len(scores) - 1)
+        if needed <= offset:
+            return self.movie_ids[0:0], np.empty(0, dtype=np.float32)
+        best = np.argpartition(-scores, needed - 1)[:needed]
+        best = best[np.argsort(-scores[best], kind="stable")][offset:]
+        return self.movie_ids[rows[best]], scores[best]
+
+    def similar_movies(self, movie_id: int, limit: int, offset: int = 0) -> list[dict]:
+        """Get the approximate neighbors of a movie in the /similar_movies response format"""
+        neighbor_ids, scores = self.neighbors(movie_id, limit, offset)
+        return [
+            {"movie_id": int(neighbor_id), "avg_score": round(float(score), 6)}
+            for neighbor_id, score in zip(neighbor_ids, scores)
+        ]
+
+    def stats(self) -> dict:
+        return {
+            "movies": len(self.movie_ids),
+            "dimensions": self.vectors.shape[1],
+            "clusters": len(self.centroids),
+            "probes": self.probes,
+        }
+
+    def _row(self, movie_id: int):
+        position = int(np.searchsorted(self.sorted_ids, movie_id))
+        if position < len(self.sorted_ids) and self.sorted_ids[position] == movie_id:
+            return int(self.sorted_rows[position])
+        return None
+
+
+def load_item_index(path: str, probes: int = 16):
+    """Load the item index at path, or return None if there is no such file"""
+    try:
+        return ItemIndex(path, probes)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,40 @@
+# master/memory.py
+# Memory of the current process, to check how much of it forked workers share.
+import os
+
+# Fields of /proc/<pid>/smaps_rollup reported, all in bytes
+_SMAPS_FIELDS = {
+    "Rss": "rss",
+    "Pss": "pss",
+    "Shared_Clean": "shared_clean",
+    "Shared_Dirty": "shared_dirty",
+    "Private_Clean": "private_clean",
+    "Private_Dirty": "private_dirty",
+}
+
+
+def process_memory() -> dict:
+    """Resident, proportional, shared and private memory of this process in bytes.
+
+    Pages inherited from the gunicorn master and never written to are shared;
+    pss splits them between the processes sharing them, so the sum of pss over
+    all workers is their real footprint. Only available on Linux.
+    """
+    usage = {"pid": os.getpid()}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in _SMAPS_FIELDS:
+                    usage[_SMAPS_FIELDS[name]] = int(value.split()[0]) * 1024
+    except OSError:
+        # Kernels before 4.14 only have the totals of statm, in pages
+        try:
+            with open("/proc/self/statm") as f:
+                _, resident, shared = (int(field) for field in f.read().split()[:3])
+        except OSError:
+            return usage
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        usage["rss"] = resident * page_size
+        usage["shared"] = shared * page_size
+    return usage
@@ -0,0 +1,147 @@
+# master/metrics.py
+# Prometheus metrics of the master service. When PROMETHEUS_MULTIPROC_DIR is set
+# (see the Dockerfile), every gunicorn worker writes its samples to that directory
+# and /metrics aggregates them, so the values cover all workers of the container.
+import os
+import time
+from contextlib import contextmanager
+
+import timing
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Couchbase KV operations take well under a millisecond on a healthy cluster
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram(
+    "master_request_duration_seconds",
+    "Latency of HTTP requests by route",
+    ["route", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_ERRORS = Counter(
+    "master_request_errors_total",
+    "HTTP requests answered with a 5xx status, by route",
+    ["route", "method", "status"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "master_requests_in_flight",
+    "HTTP requests currently being served, by route",
+    ["route"],
+    multiprocess_mode="livesum",
+)
+COUCHBASE_LATENCY = Histogram(
+    "master_couchbase_operation_duration_seconds",
+    "Latency of Couchbase operations, queries are labelled by statement name",
+    ["operation"],
+    buckets=LATENCY_BUCKETS,
+)
+COUCHBASE_ERRORS = Counter(
+    "master_couchbase_operation_errors_total",
+    "Failed Couchbase operations by exception type",
+    ["operation", "error"],
+)
+HEDGED_READS = Counter(
+    "master_hedged_reads_total",
+    "Hedged reads by outcome: primary (answered within the hedge delay), replica or "
+    "primary_after_hedge (which read won once a replica read was issued), failed, and skipped "
+    "(slow primary not hedged because no thread was free or enough reads were hedged already)",
+    ["outcome"],
+)
+REQUESTS_SHED = Counter(
+    "master_requests_shed_total",
+    "Requests rejected by admission control by priority and reason (queue_full, queue_timeout or evicted)",
+    ["priority", "reason"],
+)
+REQUESTS_QUEUED = Gauge(
+    "master_requests_queued",
+    "Requests waiting for admission, by priority",
+    ["priority"],
+    multiprocess_mode="livesum",
+)
+CACHE_LOOKUPS = Counter(
+    "master_cache_lookups_total",
+    "Cache lookups by result (hit, miss, coalesced or stale), hit ratio is hit / all lookups",
+    ["cache", "result"],
+)
+CACHE_REFRESH_ERRORS = Counter(
+    "master_cache_refresh_errors_total",
+    "Failed background refreshes of stale cache entries by exception type",
+    ["cache", "error"],
+)
+
+
+@contextmanager
+def observe_couchbase(operation: str):
+    """Time a Couchbase operation and count its failures, the duration is also a span of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        COUCHBASE_ERRORS.labels(operation, type(e).__name__).inc()
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        COUCHBASE_LATENCY.labels(operation).observe(duration)
+        timing.record(operation, duration)
+
+
+def track_cache(cache, name: str) -> None:
+    """Count the lookups and failed background refreshes of a TTLCache"""
+    cache.on_lookup = lambda result: CACHE_LOOKUPS.labels(name, result).inc()
+    cache.on_refresh_error = lambda error: CACHE_REFRESH_ERRORS.labels(name, type(error).__name__).inc()
+
+
+def init_app(app) -> None:
+    """Record latency, errors and in-flight requests of every route of a Flask app"""
+    from flask import g, request
+
+    def route_label() -> str:
+        # Label by route template, not by path, to keep the number of series bounded
+        return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_start = time.perf_counter()
+        g.metrics_route = route_label()
+        REQUESTS_IN_FLIGHT.labels(g.metrics_route).inc()
+
+    @app.after_request
+    def record_request_metrics(response):
+        start = g.get("metrics_start")
+        if start is not None:
+            labels = (g.metrics_route, request.method, str(response.status_code))
+            REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - start)
+            if response.status_code >= 500:
+                REQUEST_ERRORS.labels(*labels).inc()
+        return response
+
+    @app.teardown_request
+    def finish_request_metrics(error=None):
+        route = g.pop("metrics_route", None)
+        if route is not None:
+            REQUESTS_IN_FLIGHT.labels(route).dec()
+
+
+def render() -> tuple[bytes, str]:
+    """Render all metrics in the Prometheus text format"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid: int) -> None:
+    """Drop the live gauges of a worker that exited"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,71 @@
+# master/neighbors.py
+import mmap
+import struct
+import sys
+
+# Layout written by preprocess/merge.py --binary-output, all little-endian:
+# header, int64 offsets indexed by movie id, int32 neighbor ids, float32 scores
+NEIGHBOR_TABLE_MAGIC = b"NBRT"
+NEIGHBOR_TABLE_VERSION = 1
+NEIGHBOR_TABLE_HEADER = struct.Struct("<4sIQQ")
+
+
+class NeighborTable(object):
+    """Read-only, memory-mapped table of precomputed similar movies"""
+
+    def __init__(self, path: str) -> None:
+        if sys.byteorder != "little":
+            raise RuntimeError("Neighbor tables can only be mapped on little-endian hosts")
+
+        self.path = path
+        with open(path, "rb") as f:
+            # The mapping stays valid after the file is closed. Pages are shared
+            # through the page cache by every worker mapping the same file.
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, num_slots, num_entries = NEIGHBOR_TABLE_HEADER.unpack_from(self._mmap, 0)
+        if magic != NEIGHBOR_TABLE_MAGIC or version != NEIGHBOR_TABLE_VERSION:
+            raise ValueError(f"{path} is not a version {NEIGHBOR_TABLE_VERSION} neighbor table")
+
+        offsets_start = NEIGHBOR_TABLE_HEADER.size
+        ids_start = offsets_start + 8 * (num_slots + 1)
+        scores_start = ids_start + 4 * num_entries
+        if len(self._mmap) != scores_start + 4 * num_entries:
+            raise ValueError(f"{path} is truncated or has trailing data")
+
+        buffer = memoryview(self._mmap)
+        self.num_slots = num_slots
+        self.num_entries = num_entries
+        self.offsets = buffer[offsets_start:ids_start].cast("q")
+        self.neighbor_ids = buffer[ids_start:scores_start].cast("i")
+        self.scores = buffer[scores_start:].cast("f")
+
+    def __contains__(self, movie_id: int) -> bool:
+        return 0 <= movie_id < self.num_slots and self.offsets[movie_id] != self.offsets[movie_id + 1]
+
+    def neighbors(self, movie_id: int, limit: int = None, offset: int = 0) -> tuple:
+        """Get zero-copy views of the neighbor ids and scores of a movie, best first,
+        skipping the offset best ones"""
+        if not 0 <= movie_id < self.num_slots:
+            return self.neighbor_ids[0:0], self.scores[0:0]
+        start, end = self.offsets[movie_id], self.offsets[movie_id + 1]
+        start = min(end, start + offset)
+        if limit is not None:
+            end = min(end, start + limit)
+        return self.neighbor_ids[start:end], self.scores[start:end]
+
+    def similar_movies(self, movie_id: int, limit: int = None, offset: int = 0) -> list[dict]:
+        """Get the neighbors of a movie in the /similar_movies response format"""
+        neighbor_ids, scores = self.neighbors(movie_id, limit, offset)
+        return [
+            {"movie_id": neighbor_id, "avg_score": round(score, 6)}
+            for neighbor_id, score in zip(neighbor_ids, scores)
+        ]
+
+
+def load_neighbor_table(path: str):
+    """Map the neighbor table at path, or return None if there is no such file"""
+    try:
+        return NeighborTable(path)
+    except FileNotFoundError:
+        return None
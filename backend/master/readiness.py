@@ -0,0 +1,62 @@
+# master/readiness.py
+# Readiness of the whole container rather than of the worker that happens to
+# answer /ready. Every warm worker leaves a marker file in a directory shared by
+# the workers of the gunicorn master, and the container is ready once there is
+# a marker for each of the GUNICORN_WORKERS workers.
+import os
+import shutil
+
+# Directory of the markers, next to the metric files of the workers by default.
+# Without one, readiness is only known for the current worker.
+READINESS_DIR = os.environ.get("READINESS_DIR") or (
+    os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "ready") if os.environ.get("PROMETHEUS_MULTIPROC_DIR") else None
+)
+# Number of workers that have to be ready
+WORKERS = int(os.environ.get("GUNICORN_WORKERS", "1"))
+
+_worker_ready = False
+
+
+def marker_path(pid: int) -> str:
+    return os.path.join(READINESS_DIR, f"worker-{pid}")
+
+
+def clear() -> None:
+    """Drop the markers of a previous run, called by the gunicorn master before it forks"""
+    if READINESS_DIR:
+        shutil.rmtree(READINESS_DIR, ignore_errors=True)
+
+
+def mark_ready() -> None:
+    """Report the current worker as warm"""
+    global _worker_ready
+    _worker_ready = True
+    if READINESS_DIR:
+        os.makedirs(READINESS_DIR, exist_ok=True)
+        open(marker_path(os.getpid()), "w").close()
+
+
+def mark_exited(pid: int) -> None:
+    """Drop the marker of a worker that exited, its replacement adds its own once warm"""
+    if READINESS_DIR:
+        try:
+            os.remove(marker_path(pid))
+        except FileNotFoundError:
+            pass
+
+
+def status() -> tuple[int, int]:
+    """Number of ready workers and of workers that have to be ready"""
+    if not READINESS_DIR:
+        return int(_worker_ready), 1
+    try:
+        ready = len(os.listdir(READINESS_DIR))
+    except FileNotFoundError:
+        ready = 0
+    return ready, WORKERS
+
+
+def is_ready() -> bool:
+    """Whether the current worker and all the others are warm"""
+    ready, workers = status()
+    return _worker_ready and ready >= workers
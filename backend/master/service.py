@@ -0,0 +1,180 @@
+# master/service.py
+# Configuration and response shaping shared by the Flask app (app.py) and its
+# asyncio variant (asgi.py). Nothing in here touches a request or Couchbase, the
+# apps pass in what they read so that both answer with the same JSON.
+import hashlib
+import json
+import os
+import zlib
+from dbconnector import normalize_title
+from neighbors import load_neighbor_table
+from item_index import load_item_index
+
+# CouchDB Connection
+# COUCHDB_URL = os.environ.get("COUCHDB_URL", "http://localhost:5984")
+# DB_NAME = os.environ.get("DB_NAME", "movie_similarities")
+USE_DUMMY_DATA = os.environ.get("USE_DUMMY_DATA", "false").lower() == "true"
+
+# Recommendations keyed by normalised movie title, shared by all requests of a worker
+RECOMMENDATION_CACHE_SIZE = int(os.environ.get("RECOMMENDATION_CACHE_SIZE", "2048"))
+RECOMMENDATION_CACHE_TTL = float(os.environ.get("RECOMMENDATION_CACHE_TTL", "600"))
+# How long expired recommendations are still served while they are refreshed, or while Couchbase fails
+RECOMMENDATION_CACHE_STALE_TTL = float(os.environ.get("RECOMMENDATION_CACHE_STALE_TTL", "3600"))
+# Seconds a title without recommendations is remembered, 0 to always look it up again
+RECOMMENDATION_CACHE_NEGATIVE_TTL = float(os.environ.get("RECOMMENDATION_CACHE_NEGATIVE_TTL", "30"))
+
+# Binary neighbor table written by preprocess/merge.py --binary-output, mapped read-only
+NEIGHBOR_TABLE_PATH = os.environ.get("NEIGHBOR_TABLE_PATH", "neighbors.bin")
+# Whether movies missing from the neighbor table are looked up in the results collection
+NEIGHBOR_FALLBACK_TO_COUCHBASE = os.environ.get("NEIGHBOR_FALLBACK_TO_COUCHBASE", "true").lower() == "true"
+neighbor_table = load_neighbor_table(NEIGHBOR_TABLE_PATH)
+
+# Clustered item vectors written by preprocess/item_index.py, used for movies without neighbor lists
+ITEM_INDEX_PATH = os.environ.get("ITEM_INDEX_PATH", "item_index.npz")
+# Clusters searched per query, more is slower but closer to the exact neighbors
+ITEM_INDEX_PROBES = int(os.environ.get("ITEM_INDEX_PROBES", "16"))
+item_index = load_item_index(ITEM_INDEX_PATH, ITEM_INDEX_PROBES)
+
+# Recommendations per page when the k query parameter is missing, and the largest allowed k
+DEFAULT_PAGE_SIZE = 10
+MAX_PAGE_SIZE = int(os.environ.get("MAX_PAGE_SIZE", "50"))
+
+# Maximum number of seed movies in one batch recommendation request
+MAX_BATCH_SIZE = int(os.environ.get("MAX_BATCH_SIZE", "100"))
+# Maximum number of ratings of a user the recommendations for that user are computed from
+MAX_USER_RATINGS = int(os.environ.get("MAX_USER_RATINGS", "5000"))
+
+# Movie titles written by preprocess/movie_titles.py, the movies collection is used when missing
+MOVIE_TITLES_PATH = os.environ.get("MOVIE_TITLES_PATH", "movie_titles.csv")
+
+# Number of titles whose recommendations are loaded before the worker reports ready
+WARMUP_TITLES = int(os.environ.get("WARMUP_TITLES", "200"))
+# Titles to preload, one per line, e.g. the most requested titles of the access logs
+WARMUP_TITLES_PATH = os.environ.get("WARMUP_TITLES_PATH", "warmup_titles.txt")
+# Hot titles saved by exiting workers and preloaded by the next ones
+HOT_TITLES_PATH = os.environ.get("HOT_TITLES_PATH", "/tmp/hot_titles.txt")
+
+dummy_data = {
+    "1": {
+        "similar_movies": [
+            {"movie_id": 2, "avg_score": 0.95},
+            {"movie_id": 3, "avg_score": 0.90},
+            {"movie_id": 4, "avg_score": 0.85},
+        ]
+    },
+    "2": {
+        "similar_movies": [
+            {"movie_id": 1, "avg_score": 0.95},
+            {"movie_id": 3, "avg_score": 0.80},
+            {"movie_id": 4, "avg_score": 0.75},
+        ]
+    },
+}
+
+
+def page_params(args) -> tuple[int, int]:
+    """Read the offset and k query parameters of a paginated request, raises ValueError if they are invalid"""
+    offset = int(args.get("offset", 0))
+    k = int(args.get("k", DEFAULT_PAGE_SIZE))
+    if offset < 0 or not 1 <= k <= MAX_PAGE_SIZE:
+        raise ValueError(f"offset must be non-negative and k between 1 and {MAX_PAGE_SIZE}")
+    return offset, k
+
+
+def body_page_size(body: dict) -> int:
+    """Read k from the JSON body of a POST request, raises ValueError if it is invalid"""
+    k = int(body.get("k", DEFAULT_PAGE_SIZE))
+    if not 1 <= k <= MAX_PAGE_SIZE:
+        raise ValueError(f"k must be between 1 and {MAX_PAGE_SIZE}")
+    return k
+
+
+def parse_batch(body: dict) -> tuple[list[int], list[str]]:
+    """Read the movie ids and titles of a batch recommendation request, raises ValueError if they are invalid"""
+    movieIds = body.get("movieIds", [])
+    movieNames = body.get("movieNames", [])
+    if not isinstance(movieIds, list) or not isinstance(movieNames, list):
+        raise ValueError("movieIds and movieNames must be lists")
+    if len(movieIds) + len(movieNames) > MAX_BATCH_SIZE:
+        raise ValueError(f"At most {MAX_BATCH_SIZE} movies per batch")
+    # Like the seeds of a taste profile: JSON true, 1.9 or 1e400 are not movie ids
+    if any(isinstance(movieId, bool) or not isinstance(movieId, int) for movieId in movieIds):
+        raise ValueError("movieIds must be integers")
+    if not all(isinstance(name, str) for name in movieNames):
+        raise ValueError("movieNames must be strings")
+    return movieIds, movieNames
+
+
+def similar_movies_response(items: list[dict]) -> list[dict]:
+    """Neighbors read from the results collection, in the format of the /similar_movies responses"""
+    return [
+        {"movie_id": item["movieId"], "avg_score": item["avg_score"]}
+        for item in items
+    ]
+
+
+def approximate_neighbors(movieId, offset: int, k: int):
+    """Get a page of approximate neighbors of a movie from the item vectors, without
+    titles, or None if the movie has no item vector"""
+    if movieId is None or movieId not in item_index:
+        return None
+    neighbor_ids, scores = item_index.neighbors(movieId, k, offset)
+    return [
+        {"movieId": int(neighbor_id), "avg_score": round(float(score), 6)}
+        for neighbor_id, score in zip(neighbor_ids, scores)
+    ]
+
+
+def join_titles(recommendation_results: list[dict], movie_docs: dict) -> list[dict]:
+    """Add the titles of movie_docs, keyed by movie id string, to recommendations"""
+    for item in recommendation_results:
+        item["title"] = movie_docs.get(str(item["movieId"]))
+    return recommendation_results
+
+
+def scored_movies(top: list[tuple], movie_docs: dict) -> list[dict]:
+    """Join the titles of (movie id, score) pairs, in the response format of the aggregated recommendations"""
+    return [
+        {"movieId": movieId, "title": movie_docs.get(str(movieId)), "score": round(score, 6)}
+        for movieId, score in top
+    ]
+
+
+def encode_recommendations(recommendation_results: list[dict], cas) -> tuple[bytes, str]:
+    """Encode a page of recommendations as cached, with a version for the ETag"""
+    # Sorted keys like the JSON responses of Flask and Quart, without whitespace
+    body = json.dumps(recommendation_results, separators=(",", ":"), sort_keys=True).encode()
+    # The CAS changes whenever the source document is rewritten, e.g. by dbimport.py
+    version = f"{cas:x}" if cas else hashlib.sha1(body).hexdigest()[:16]
+    return body, version
+
+
+def recommendations_etag(version: str, movieName: str, offset: int, k: int) -> str:
+    """ETag of a page of recommendations of /get-recommendations-by-name"""
+    # The response echoes the requested name, so it is part of the ETag along with the data version and page
+    return f"{version}-{zlib.crc32(f'{movieName}|{offset}|{k}'.encode()):08x}"
+
+
+def recommendations_body(movieName: str, recommendations: bytes) -> bytes:
+    """Response body of /get-recommendations-by-name, only the requested name is encoded per request"""
+    return b'{"movieName":' + json.dumps(movieName).encode() + b',"recommendedMovies":' + recommendations + b'}\n'
+
+
+def batch_results(movieIds: list, movieNames: list[str], nameIds: dict, recommendations: dict, logger) -> list[dict]:
+    """Report the status of each requested movie of a batch separately"""
+    items = [{"movieId": movieId} for movieId in movieIds]
+    items += [
+        {"movieName": name, "movieId": nameIds.get(normalize_title(name))}
+        for name in movieNames
+    ]
+    for item in items:
+        result = recommendations.get(item["movieId"])
+        if isinstance(result, list):
+            item["status"] = "ok"
+            item["recommendedMovies"] = result
+        elif isinstance(result, Exception):
+            logger.error(f"Error retrieving recommendations of movie {item['movieId']}: {result}")
+            item["status"] = "error"
+        else:
+            item["status"] = "not_found"
+    return items
@@ -0,0 +1,162 @@
+# master/taste.py
+# Recommendations for a taste profile of several seed movies, or for the ratings
+# of a user: the neighbor lists of the movies are added up with the weight of
+# each movie, and the best movies that are not among them are recommended.
+import math
+
+import numpy as np
+
+
+def parse_seeds(seeds, max_seeds: int) -> list[dict]:
+    """Validate the seeds of a taste profile request, raises ValueError if they are invalid.
+
+    Every seed is a dict with a movieId or a movieName and an optional weight, 1 by default.
+    """
+    if not isinstance(seeds, list) or not seeds:
+        raise ValueError("seeds must be a non-empty list")
+    if len(seeds) > max_seeds:
+        raise ValueError(f"At most {max_seeds} seeds per profile")
+
+    parsed = []
+    for seed in seeds:
+        if not isinstance(seed, dict) or ("movieId" in seed) == ("movieName" in seed):
+            raise ValueError("Every seed must have either a movieId or a movieName")
+        weight = seed.get("weight", 1)
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)) or not math.isfinite(weight):
+            raise ValueError("Seed weights must be finite numbers")
+        if "movieId" in seed:
+            if isinstance(seed["movieId"], bool) or not isinstance(seed["movieId"], int):
+                raise ValueError("movieId must be an integer")
+            parsed.append({"movieId": seed["movieId"], "weight": weight})
+        else:
+            if not isinstance(seed["movieName"], str):
+                raise ValueError("movieName must be a string")
+            parsed.append({"movieName": seed["movieName"], "weight": weight})
+    return parsed
+
+
+def parse_ratings(ratings, max_ratings: int) -> tuple:
+    """Validate the ratings of a request, a list of {"movieId", "rating"}, raises ValueError if they are invalid.
+
+    Returns the movie ids and their ratings, the last rating of a movie wins.
+    """
+    if not isinstance(ratings, list) or not ratings:
+        raise ValueError("ratings must be a non-empty list")
+    if len(ratings) > max_ratings:
+        raise ValueError(f"At most {max_ratings} ratings per request")
+
+    parsed = {}
+    for item in ratings:
+        if not isinstance(item, dict):
+            raise ValueError("Every rating must have a movieId and a rating")
+        movie_id, rating = item.get("movieId"), item.get("rating")
+        if isinstance(movie_id, bool) or not isinstance(movie_id, int):
+            raise ValueError("movieId must be an integer")
+        if isinstance(rating, bool) or not isinstance(rating, (int, float)) or not 0 <= rating <= 5:
+            raise ValueError("rating must be a number between 0 and 5")
+        parsed[movie_id] = rating
+    return list(parsed), list(parsed.values())
+
+
+def neighbor_arrays(neighbors: list[dict]) -> tuple:
+    """Convert a neighbor list of the results collection to arrays of ids and scores"""
+    ids = np.fromiter((item["movieId"] for item in neighbors), dtype=np.int64, count=len(neighbors))
+    scores = np.fromiter((item["avg_score"] for item in neighbors), dtype=np.float64, count=len(neighbors))
+    return ids, scores
+
+
+def table_arrays(neighbor_table, movie_id: int) -> tuple:
+    """Get zero-copy arrays of the ids and scores of a movie in a neighbor table"""
+    ids, scores = neighbor_table.neighbors(movie_id)
+    return np.asarray(ids), np.asarray(scores)
+
+
+def top_movies(neighbor_lists: list[tuple], weights: list[float], exclude: list[int], k: int) -> list[tuple]:
+    """Get the k movies with the highest weighted sum of scores over neighbor lists, best first.
+
+    neighbor_lists are (ids, scores) array pairs, movies in exclude are never returned.
+    """
+    if not neighbor_lists:
+        return []
+    ids = np.concatenate([ids for ids, _ in neighbor_lists]).astype(np.int64, copy=False)
+    contributions = np.concatenate([
+        np.asarray(scores, dtype=np.float64) * weight for (_, scores), weight in zip(neighbor_lists, weights)
+    ])
+
+    # Dense index of the candidate movies, the contributions are summed by index in one pass
+    candidates, positions = np.unique(ids, return_inverse=True)
+    totals = np.bincount(positions, weights=contributions, minlength=len(candidates))
+    keep = ~np.isin(candidates, exclude)
+    return best_movies(candidates[keep], totals[keep], k)
+
+
+def best_movies(movie_ids, totals, k: int) -> list[tuple]:
+    """Get the k movies with the highest totals as (movie id, total) pairs, best first"""
+    k = min(k, len(totals))
+    if k <= 0:
+        return []
+    # Only the k best are sorted
+    best = np.argpartition(-totals, k - 1)[:k]
+    best = best[np.argsort(-totals[best], kind="stable")]
+    return [(int(movie_ids[i]), float(totals[i])) for i in best]
+
+
+def rating_recommendations(neighbor_table, movie_ids: list[int], ratings: list[float], k: int) -> list[tuple]:
+    """Get the top k movies for the ratings of a user, rated movies excluded.
+
+    Movies are scored by multiplying the ratings, centred on their mean so that
+    disliked movies count against their neighbors, by the neighbor table read as
+    a sparse CSR matrix: offsets, neighbor ids and scores are its row pointers,
+    column indices and values.
+    """
+    movie_ids = np.asarray(movie_ids, dtype=np.int64)
+    weights = np.asarray(ratings, dtype=np.float64)
+    weights = weights - weights.mean()
+    if not weights.any():
+        # Every movie got the same rating, they all count the same
+        weights = np.ones_like(weights)
+
+    rows = (movie_ids >= 0) & (movie_ids < neighbor_table.num_slots)
+    rows, weights = movie_ids[rows], weights[rows]
+    indptr = np.asarray(neighbor_table.offsets)
+    starts = indptr[rows]
+    lengths = indptr[rows + 1] - starts
+
+    # Positions of the entries of all the rated rows, gathered without a Python loop
+    ends = np.cumsum(lengths)
+    positions = np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
+    ids = np.asarray(neighbor_table.neighbor_ids)[positions]
+    contributions = np.asarray(neighbor_table.scores)[positions] * np.repeat(weights, lengths)
+
+    # Movie ids are the dense index of the scores
+    totals = np.bincount(ids, weights=contributions, minlength=neighbor_table.num_slots)
+    scored = np.zeros(len(totals), dtype=bool)
+    scored[ids] = True
+    scored[movie_ids[(movie_ids >= 0) & (movie_ids < len(totals))]] = False
+    candidates = np.flatnonzero(scored)
+    return best_movies(candidates, totals[candidates], k)
+
+
+def profile_recommendations(seeds: list[dict], neighbor_lists: dict, k: int) -> list[tuple]:
+    """Get the top k movies of a taste profile and set the status of every seed.
+
+    seeds have a resolved movieId, None when it is unknown. neighbor_lists map seed
+    ids to (ids, scores) arrays, None when the movie has no neighbors, or the
+    exception raised while fetching them. A movie given as several seeds counts
+    with the sum of their weights.
+    """
+    weights = {}
+    for seed in seeds:
+        result = neighbor_lists.get(seed["movieId"])
+        if isinstance(result, tuple):
+            seed["status"] = "ok"
+            weights[seed["movieId"]] = weights.get(seed["movieId"], 0) + seed["weight"]
+        elif isinstance(result, Exception):
+            seed["status"] = "error"
+        else:
+            seed["status"] = "not_found"
+
+    seed_ids = [seed["movieId"] for seed in seeds if seed["movieId"] is not None]
+    return top_movies(
+        [neighbor_lists[movie_id] for movie_id in weights], list(weights.values()), seed_ids, k
+    )
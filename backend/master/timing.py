@@ -0,0 +1,88 @@
+# master/timing.py
+# Lightweight per-request phase timing. Spans are kept in a context variable, which
+# is local to the current greenlet, thread or asyncio task, so code outside Flask
+# (e.g. dbconnector) can record phases without access to the request.
+import json
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_spans = ContextVar("request_spans", default=None)
+
+slow_request_logger = logging.getLogger("master.slow_requests")
+
+
+def start_request() -> None:
+    """Start collecting spans for the current request"""
+    _spans.set({})
+
+
+def record(name: str, duration: float) -> None:
+    """Add a duration in seconds to a phase of the current request, if any"""
+    spans = _spans.get()
+    if spans is not None:
+        total, count = spans.get(name, (0.0, 0))
+        spans[name] = (total + duration, count + 1)
+
+
+@contextmanager
+def span(name: str):
+    """Time a phase of the current request"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+def finish_request() -> dict:
+    """Stop collecting spans, returns phase name -> (total seconds, count)"""
+    spans = _spans.get()
+    _spans.set(None)
+    return spans or {}
+
+
+def server_timing_header(spans: dict, total: float) -> str:
+    """Format spans as a Server-Timing header value, durations in milliseconds"""
+    # Metric names are HTTP tokens, so the ':' of query statement names is replaced
+    entries = [
+        f"{name.replace(':', '.')};dur={duration * 1000:.2f}"
+        for name, (duration, _) in spans.items()
+    ]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+def init_app(app, slow_request_threshold: float) -> None:
+    """Send phase timings of every request of a Flask app in a Server-Timing header,
+    and log requests slower than slow_request_threshold seconds"""
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timing():
+        g.timing_start = time.perf_counter()
+        start_request()
+
+    @app.after_request
+    def finish_request_timing(response):
+        spans = finish_request()
+        start = g.get("timing_start")
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        response.headers["Server-Timing"] = server_timing_header(spans, total)
+
+        if total >= slow_request_threshold:
+            slow_request_logger.warning(json.dumps({
+                "event": "slow_request",
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "duration_ms": round(total * 1000, 2),
+                "spans": {
+                    name: {"duration_ms": round(duration * 1000, 2), "count": count}
+                    for name, (duration, count) in spans.items()
+                },
+            }))
+        return response
@@ -0,0 +1,40 @@
+# master/warmup.py
+# Titles a new worker loads before it reports ready. The hot titles saved by the
+# previous process come first, then the popularity file, then the most rated
+# movies of the catalog, so a fresh deploy still starts with the likely requests.
+import os
+
+from dbconnector import normalize_title
+
+
+def read_titles(path: str) -> list[str]:
+    """Read one title per line, or nothing if there is no such file"""
+    if not path or not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def warmup_titles(snapshot_path: str, popularity_path: str, catalog, limit: int) -> list[str]:
+    """Get up to limit distinct titles to preload, most likely to be requested first"""
+    candidates = read_titles(snapshot_path) + read_titles(popularity_path)
+    if catalog is not None:
+        candidates += catalog.most_rated_titles(limit)
+
+    titles = {}
+    for title in candidates:
+        titles.setdefault(normalize_title(title), title)
+        if len(titles) >= limit:
+            break
+    return list(titles.values())
+
+
+def save_hot_titles(cache, path: str, limit: int) -> None:
+    """Save the titles of the most recently used entries of the recommendations cache"""
+    # Cache keys are (normalised title, offset, k), each title is saved once
+    titles = list(dict.fromkeys(key[0] for key in cache.keys()))[:limit]
+    # Workers exit concurrently, each replaces the whole file at once
+    tmp_path = f"{path}.{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(f"{title}\n" for title in titles)
+    os.replace(tmp_path, path)
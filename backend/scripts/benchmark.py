@@ -0,0 +1,164 @@
+"""
+Compare the throughput of master service deployments, e.g. gunicorn+gevent (app.py)
+against uvicorn (asgi.py), in requests per second per core.
+
+Example:
+    python benchmark.py \\
+        --target gevent=http://localhost:8000 --pid gevent=<gunicorn master pid> \\
+        --target asgi=http://localhost:8001 --pid asgi=<gunicorn master pid> \\
+        --movies ../../jmeter-test-script/movie.csv --duration 30 --concurrency 64
+
+CPU time is read from /proc for the given process and all of its children, so the
+servers must run on the same host (container processes are visible from the host).
+Without --pid, --cores is used to normalise the throughput instead.
+"""
+import argparse
+import asyncio
+import csv
+import os
+import time
+from urllib.parse import quote, urlsplit
+
+
+def read_paths(movies_path, endpoints):
+    """Build the request paths from a CSV file with a movieName column"""
+    with open(movies_path, newline="", encoding="utf-8") as f:
+        names = [row["movieName"] for row in csv.DictReader(f) if row.get("movieName")]
+
+    paths = []
+    for name in names:
+        if "recommendations" in endpoints:
+            paths.append(f"/get-recommendations-by-name/{quote(name)}")
+        if "autosuggestions" in endpoints:
+            # What the frontend sends while the title is being typed
+            paths.extend(f"/get-autosuggestions/{quote(name[:i])}" for i in range(3, min(len(name), 8) + 1))
+    return paths
+
+
+def process_tree_cpu_seconds(pid):
+    """User and system CPU time of a process and all its descendants"""
+    parents = {}
+    times = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # The command name may contain spaces, fields start after its closing parenthesis
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        parents[int(entry)] = int(fields[1])
+        times[int(entry)] = int(fields[11]) + int(fields[12])
+
+    tree = {pid}
+    changed = True
+    while changed:
+        children = {child for child, parent in parents.items() if parent in tree}
+        changed = not children <= tree
+        tree |= children
+    return sum(times.get(p, 0) for p in tree) / os.sysconf("SC_CLK_TCK")
+
+
+async def read_response(reader):
+    """Read one HTTP/1.1 response with a Content-Length, returns the status code"""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def run_connection(url, paths, offset, deadline, latencies, errors):
+    """Send requests over one keep-alive connection until the deadline"""
+    parts = urlsplit(url)
+    host, port = parts.hostname, parts.port or 80
+    reader = writer = None
+    i = offset
+    while time.monotonic() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            start = time.perf_counter()
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: keep-alive\r\n\r\n".encode())
+            status = await read_response(reader)
+            latencies.append(time.perf_counter() - start)
+            if status >= 500:
+                errors.append(status)
+        except (OSError, asyncio.IncompleteReadError, ValueError):
+            errors.append(0)
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def benchmark(url, paths, duration, concurrency):
+    """Run a closed-loop load test, returns latencies of completed requests and errors"""
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*(
+        run_connection(url, paths, c * 7, deadline, latencies, errors)
+        for c in range(concurrency)
+    ))
+    return latencies, errors
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(p / 100 * len(sorted_values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark master service deployments")
+    parser.add_argument("--target", action="append", required=True, help="name=base URL, repeatable")
+    parser.add_argument("--pid", action="append", default=[], help="name=server pid to measure CPU time of")
+    parser.add_argument("--cores", type=float, default=1, help="Cores used by each server, without --pid (default: 1)")
+    parser.add_argument("--movies", default="../../jmeter-test-script/movie.csv", help="CSV file with a movieName column")
+    parser.add_argument(
+        "--endpoints",
+        default="recommendations,autosuggestions",
+        help="Comma separated endpoints to call (default: recommendations,autosuggestions)",
+    )
+    parser.add_argument("--duration", type=float, default=30, help="Seconds of measured load (default: 30)")
+    parser.add_argument("--warmup", type=float, default=5, help="Seconds of unmeasured load first (default: 5)")
+    parser.add_argument("--concurrency", type=int, default=64, help="Concurrent connections (default: 64)")
+    args = parser.parse_args()
+
+    paths = read_paths(args.movies, args.endpoints.split(","))
+    pids = dict(item.split("=", 1) for item in args.pid)
+
+    print(f"{'target':<12}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'cpu s':>8}{'req/s/core':>12}")
+    for target in args.target:
+        name, url = target.split("=", 1)
+        # Warm the server up first so that caches and connections do not skew the results
+        if args.warmup > 0:
+            asyncio.run(benchmark(url, paths, args.warmup, args.concurrency))
+
+        cpu_before = process_tree_cpu_seconds(int(pids[name])) if name in pids else None
+        latencies, errors = asyncio.run(benchmark(url, paths, args.duration, args.concurrency))
+        cpu_seconds = None
+        if cpu_before is not None:
+            cpu_seconds = process_tree_cpu_seconds(int(pids[name])) - cpu_before
+
+        latencies.sort()
+        rps = len(latencies) / args.duration
+        per_core = len(latencies) / cpu_seconds if cpu_seconds else rps / args.cores
+        print(
+            f"{name:<12}{len(latencies):>10}{len(errors):>8}{rps:>10.1f}"
+            f"{percentile(latencies, 50) * 1000:>9.1f}{percentile(latencies, 99) * 1000:>9.1f}"
+            f"{cpu_seconds if cpu_seconds is not None else float('nan'):>8.1f}{per_core:>12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
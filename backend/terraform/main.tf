@@ -163,7 +163,7 @@ resource "aws_lb_target_group" "movie_rec_tg" {
   target_type = "instance"
 
   health_check {
-    path                = "/health"
+    path                = "/ready"
     interval            = 30
     timeout             = 5
     healthy_threshold   = 2
@@ -14,6 +14,32 @@ DB_CONN_STR="couchbase://dsd1.canadacentral.cloudapp.azure.com,dsd2.canadacentra
 DB_USERNAME="dsdadmin"
 DB_PASSWORD="Dsd@2024"
 
+# Collection holding precomputed recommendation responses, written by couchbase-connector/dbimport.py
+RECOMMENDATIONS_COLLECTION = "recommendations"
+
+
+# Secondary indexes of the queries of the backend, created by dbimport.py
+QUERY_INDEXES = {
+    # Covers the rating history of a user (get_user_ratings of the backend)
+    "idx_reviews_user_ratings": "CREATE INDEX `idx_reviews_user_ratings` IF NOT EXISTS ON `reviews`(userId, movieId, rating);",
+}
+
+
+def normalize_title(title: str) -> str:
+    """Normalise a movie title for case and whitespace insensitive lookups"""
+    return " ".join(title.split()).lower()
+
+
+def recommendation_key_by_id(movie_id) -> str:
+    """Key of the precomputed recommendations document of a movie id"""
+    return f"id::{movie_id}"
+
+
+def recommendation_key_by_title(title: str) -> str:
+    """Key of the precomputed recommendations document of a movie title"""
+    return f"title::{normalize_title(title)}"
+
+
 class CouchbaseClient(object):
     """Class to handle interactions with Couchbase cluster"""
 
@@ -119,6 +145,15 @@ class CouchbaseClient(object):
         except Exception as e:
             print(f"Error upserting index '{self.index_name}': {e}")
 
+    def create_query_indexes(self) -> None:
+        """Create the secondary indexes of the backend queries that do not exist yet"""
+        for name, statement in QUERY_INDEXES.items():
+            try:
+                list(self.query(statement))
+                print(f"Index '{name}' created or already present.")
+            except Exception as e:
+                print(f"Error creating index '{name}': {e}")
+
     def get_document(self, collection_name: str, key: str):
         """Get document by key using KV operation"""
         return self.scope.collection(collection_name).get(key)
@@ -148,6 +183,16 @@ class CouchbaseClient(object):
         results = list(map(lambda x: x['title'],list(q_res)))
         return results
 
+    def get_all_movie_titles(self) -> list[dict]:
+        """Get the id and title of every movie"""
+        q_str = 'SELECT t.movieId, t.title FROM `movies` t;'
+        return list(self.query(q_str))
+
+    def get_movie_rating_counts(self) -> dict:
+        """Get the number of reviews of each movie"""
+        q_str = 'SELECT r.movieId, COUNT(1) AS ratings FROM `reviews` r GROUP BY r.movieId;'
+        return {int(item['movieId']): item['ratings'] for item in self.query(q_str)}
+
     def get_reviews_in_chunk(self, size:int=100, offset:int=0) -> list[dict]:
         """Get reviews in chunks"""
         q_str = 'SELECT r.movieId, r.rating, r.title, r.userId FROM `reviews` r LIMIT $size OFFSET $offset;'
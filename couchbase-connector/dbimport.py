@@ -1,15 +1,95 @@
-from dbconnector import CouchbaseClient
+from dbconnector import (
+    CouchbaseClient,
+    RECOMMENDATIONS_COLLECTION,
+    recommendation_key_by_id,
+    recommendation_key_by_title,
+)
+import argparse
 import json
 
-if __name__ == "__main__":
+
+def build_recommendation_docs(similarities: dict, titles: dict, top_k: int):
+    """Build recommendation responses with the titles of every movie resolved"""
+    for key, value in similarities.items():
+        movie_id = int(key)
+        recommended_movies = [
+            {
+                "movieId": item["movieId"],
+                "avg_score": item["avg_score"],
+                "title": titles.get(int(item["movieId"])),
+            }
+            for item in value[:top_k]
+        ]
+        yield {
+            "movieId": movie_id,
+            "title": titles.get(movie_id),
+            "recommendedMovies": recommended_movies,
+        }
+
+
+def most_rated_by_title(movies: list[dict], rating_counts: dict) -> dict:
+    """Map every normalised title to the most rated movie with that title,
+    the movie the backend catalog resolves the title to"""
+    best = {}
+    for movie in movies:
+        movie_id = int(movie['movieId'])
+        key = recommendation_key_by_title(movie['title'])
+        ratings = rating_counts.get(movie_id, 0)
+        if key not in best or ratings > best[key][1]:
+            best[key] = (movie_id, ratings)
+    return {key: movie_id for key, (movie_id, _) in best.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import merged movie similarities into Couchbase")
+    parser.add_argument(
+        "--input",
+        default="final_similarities.json",
+        help="Merged similarities JSON file (default: final_similarities.json)",
+    )
+    parser.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="Number of recommendations kept in each recommendations document (default: 20)",
+    )
+    parser.add_argument(
+        "--skip-results",
+        action="store_true",
+        help="Only write the recommendations collection, not the raw results",
+    )
+    args = parser.parse_args()
+
     # Create a new client instance and connect to the DB cluster
     client = CouchbaseClient()
     client.init_app()
+    client.create_query_indexes()
 
     # Load a json file
-    with open('final_similarities.json') as f:
+    with open(args.input) as f:
         data = json.load(f)
 
-    for key, value in data.items():
-        print(key, len(value))
-        client.upsert_document('results', key, value)
+    if not args.skip_results:
+        for key, value in data.items():
+            print(key, len(value))
+            client.upsert_document('results', key, value)
+
+    # Write each response twice, keyed by movie id and by normalised title, so
+    # that the backend can serve a request with a single KV get
+    movies = [movie for movie in client.get_all_movie_titles() if movie.get('title')]
+    titles = {int(movie['movieId']): movie['title'] for movie in movies}
+    movie_ids_by_title = most_rated_by_title(movies, client.get_movie_rating_counts())
+    title_keys = set()
+    for doc in build_recommendation_docs(data, titles, args.top):
+        client.upsert_document(RECOMMENDATIONS_COLLECTION, recommendation_key_by_id(doc['movieId']), doc)
+
+        # Titles shared by several movies keep the most rated one, keys are limited to 250 bytes
+        title_key = recommendation_key_by_title(doc['title']) if doc['title'] else None
+        if title_key and movie_ids_by_title.get(title_key) == doc['movieId'] and len(title_key.encode()) <= 250:
+            client.upsert_document(RECOMMENDATIONS_COLLECTION, title_key, doc)
+            title_keys.add(title_key)
+    print(f"Imported recommendations for {len(data)} movies, {len(title_keys)} titles")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from sklearn.cluster import KMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
+
+# Item index layout, an uncompressed .npz read by backend/master/item_index.py.
+# Movies are clustered around centroids (an inverted file index) and stored grouped by cluster:
+# - movie_ids: int32[n], movie of each row
+# - vectors: float32[n, dimensions], unit length
+# - list_offsets: int64[lists + 1], rows of cluster c are list_offsets[c] to list_offsets[c + 1]
+# - centroids: float32[lists, dimensions], unit length
+# - sorted_ids, sorted_rows: int32[n], movie ids in increasing order and their rows
+ITEM_INDEX_VERSION = 1
+
+# Number of clusters searched for each movie when measuring the recall
+DEFAULT_PROBES = 16
+
+
+def build_item_vectors(ratings, dimensions, seed):
+    """
+    Build unit-length movie vectors whose dot products approximate the cosine
+    similarity of the rating columns, as computed by precompute.py.
+
+    Args:
+    - ratings (DataFrame): userId, movieId and rating columns
+    - dimensions (int): Number of dimensions of the vectors
+    - seed (int): Seed of the randomized SVD
+
+    Returns:
+    - movie_ids (ndarray): Sorted movie ids
+    - vectors (ndarray): One row per movie id
+    - columns (csr_matrix): Unit-length rating vectors of the movies, one row per movie id
+    """
+    user_ids, user_rows = np.unique(ratings["userId"].to_numpy(), return_inverse=True)
+    movie_ids, movie_rows = np.unique(ratings["movieId"].to_numpy(), return_inverse=True)
+
+    # Movies x users, like the transposed pivot table of precompute.py but sparse
+    columns = csr_matrix(
+        (ratings["rating"].to_numpy(dtype=np.float32) / 5, (movie_rows, user_rows)),
+        shape=(len(movie_ids), len(user_ids)),
+    )
+    columns = normalize(columns, axis=1)
+
+    dimensions = min(dimensions, min(columns.shape) - 1)
+    vectors = TruncatedSVD(n_components=dimensions, random_state=seed).fit_transform(columns)
+    vectors = normalize(vectors, axis=1).astype(np.float32)
+    return movie_ids.astype(np.int32), vectors, columns
+
+
+def cluster_vectors(vectors, lists, seed):
+    """
+    Cluster unit-length vectors with k-means on the unit sphere.
+
+    Returns:
+    - centroids (ndarray): float32[lists, dimensions], unit length
+    - labels (ndarray): Cluster of every vector
+    """
+    kmeans = KMeans(n_clusters=lists, n_init=1, max_iter=20, random_state=seed).fit(vectors)
+    centroids = normalize(kmeans.cluster_centers_, axis=1).astype(np.float32)
+    # Vectors are assigned by cosine similarity, like the queries
+    labels = np.argmax(vectors @ centroids.T, axis=1)
+    return centroids, labels
+
+
+def search(index, row, k, probes):
+    """
+    Approximate top k rows most similar to a row, same search as backend/master/item_index.py.
+    The movies of the probes clusters whose centroids are closest to the row are ranked exactly.
+    """
+    query = index["vectors"][row]
+    centroid_scores = index["centroids"] @ query
+    probes = min(probes, len(centroid_scores))
+    rows, scores = [], []
+    for cluster in np.argpartition(-centroid_scores, probes - 1)[:probes]:
+        start, end = index["list_offsets"][cluster], index["list_offsets"][cluster + 1]
+        rows.append(np.arange(start, end))
+        scores.append(index["vectors"][start:end] @ query)
+    rows, scores = np.concatenate(rows), np.concatenate(scores)
+    scores[rows == row] = -np.inf
+    k = min(k, len(scores) - 1)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return rows[best[np.argsort(-scores[best])]]
+
+
+def exact_top(similarities, row, k):
+    """Rows of the k highest similarities, excluding the row itself"""
+    similarities[row] = -np.inf
+    best = np.argpartition(-similarities, k - 1)[:k]
+    return set(best[np.argsort(-similarities[best])].tolist())
+
+
+def report_recall(index, columns, k, samples, probes, seed):
+    """
+    Print the recall at k of the index against exact cosine similarity of the
+    item vectors and of the rating columns, for a sample of movies.
+    columns are the rating vectors in the row order of the index.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(index["vectors"]), size=min(samples, len(index["vectors"])), replace=False)
+    vector_hits = column_hits = exact_vector_hits = 0
+    search_time = 0.0
+    for row in rows:
+        start = time.perf_counter()
+        found = set(search(index, row, k, probes).tolist())
+        search_time += time.perf_counter() - start
+
+        vector_top = exact_top(index["vectors"] @ index["vectors"][row], row, k)
+        column_top = exact_top(np.asarray((columns @ columns[row].T).todense()).ravel(), row, k)
+        vector_hits += len(found & vector_top)
+        column_hits += len(found & column_top)
+        exact_vector_hits += len(vector_top & column_top)
+
+    print(f"Recall@{k} over {len(rows)} movies, {probes} clusters probed:")
+    print(f"  against exact cosine of the item vectors: {vector_hits / (k * len(rows)):.3f}")
+    print(f"  against exact cosine of the ratings: {column_hits / (k * len(rows)):.3f}")
+    print(f"  (exact search of the item vectors against the ratings: {exact_vector_hits / (k * len(rows)):.3f})")
+    print(f"  average search time: {search_time / len(rows) * 1000:.2f} ms")
+
+
+def build_item_index(ratings_path, output_file, dimensions=128, lists=None, probes=DEFAULT_PROBES, recall_k=50, recall_samples=200, seed=42):
+    """
+    Build the approximate nearest-neighbor index used by the backend for movies
+    without precomputed neighbors.
+
+    Args:
+    - ratings_path (str): Path to ratings CSV file
+    - output_file (str): Path to save the item index (.npz)
+    - dimensions (int): Number of dimensions of the item vectors
+    - lists (int): Number of clusters, the square root of the number of movies by default
+    - probes (int): Number of clusters searched when measuring the recall
+    - recall_k (int): Number of neighbors the recall is measured at, 0 to skip it
+    - recall_samples (int): Number of movies the recall is measured on
+    - seed (int): Seed of the SVD, k-means and samples
+    """
+    ratings = pd.read_csv(ratings_path, usecols=["userId", "movieId", "rating"])
+
+    start = time.perf_counter()
+    movie_ids, vectors, columns = build_item_vectors(ratings, dimensions, seed)
+    print(f"Item vectors: {vectors.shape} in {time.perf_counter() - start:.1f}s")
+
+    start = time.perf_counter()
+    lists = min(lists or max(1, round(np.sqrt(len(movie_ids)))), len(movie_ids))
+    centroids, labels = cluster_vectors(vectors, lists, seed)
+    print(f"Clusters: {lists} in {time.perf_counter() - start:.1f}s")
+
+    # Rows are grouped by cluster, so that a cluster is searched with a single matrix product
+    order = np.argsort(labels, kind="stable")
+    sorted_rows = np.empty(len(order), dtype=np.int32)
+    sorted_rows[order] = np.arange(len(order), dtype=np.int32)
+    index = {
+        "version": np.int32(ITEM_INDEX_VERSION),
+        "movie_ids": movie_ids[order],
+        "vectors": vectors[order],
+        "list_offsets": np.searchsorted(labels[order], np.arange(lists + 1)).astype(np.int64),
+        "centroids": centroids,
+        "sorted_ids": movie_ids,
+        "sorted_rows": sorted_rows,
+    }
+    np.savez(output_file, **index)
+    print(f"Item index saved to {output_file}: {len(movie_ids)} movies in {lists} clusters")
+
+    if recall_k > 0:
+        report_recall(index, columns[order], min(recall_k, len(movie_ids) - 1), recall_samples, probes, seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the approximate nearest-neighbor index of the backend")
+    parser.add_argument(
+        "--ratings",
+        default="./archive/rating.csv",
+        help="Path to ratings CSV file (default: ./archive/rating.csv)",
+    )
+    parser.add_argument(
+        "--output",
+        default="./item_index.npz",
+        help="Path to save the item index (default: ./item_index.npz)",
+    )
+    parser.add_argument(
+        "--dimensions",
+        type=int,
+        default=128,
+        help="Number of dimensions of the item vectors (default: 128)",
+    )
+    parser.add_argument(
+        "--lists",
+        type=int,
+        default=None,
+        help="Number of clusters (default: square root of the number of movies)",
+    )
+    parser.add_argument(
+        "--probes",
+        type=int,
+        default=DEFAULT_PROBES,
+        help=f"Number of clusters searched when measuring the recall (default: {DEFAULT_PROBES})",
+    )
+    parser.add_argument(
+        "--recall-k",
+        type=int,
+        default=50,
+        help="Number of neighbors the recall is reported at, 0 to skip it (default: 50)",
+    )
+    parser.add_argument(
+        "--recall-samples",
+        type=int,
+        default=200,
+        help="Number of movies the recall is measured on (default: 200)",
+    )
+
+    args = parser.parse_args()
+
+    build_item_index(
+        args.ratings, args.output, args.dimensions, args.lists, args.probes, args.recall_k, args.recall_samples
+    )
+
+
+if __name__ == "__main__":
+    main()
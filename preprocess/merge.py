@@ -1,10 +1,60 @@
 import os
+import sys
 import json
+import struct
+from array import array
 from collections import defaultdict
 import argparse
 
+# Binary neighbor table layout, all little-endian (read by backend/master/neighbors.py):
+# - header: magic, format version, number of movie id slots, number of neighbor entries
+# - offsets: int64[slots + 1], neighbors of movie m are entries offsets[m] to offsets[m + 1]
+# - neighbor ids: int32[entries], sorted by descending score within each movie
+# - scores: float32[entries]
+NEIGHBOR_TABLE_MAGIC = b"NBRT"
+NEIGHBOR_TABLE_VERSION = 1
+NEIGHBOR_TABLE_HEADER = struct.Struct("<4sIQQ")
 
-def merge_similarity_files(input_dir, output_file, top_n=50):
+
+def write_neighbor_table(merged_similarities, output_file):
+    """
+    Write merged similarities as a binary neighbor table that can be memory-mapped.
+
+    Args:
+    - merged_similarities (dict): Source movie id to list of {"movieId", "avg_score"}, sorted by score
+    - output_file (str): Path to save the binary neighbor table
+    """
+    num_slots = max((int(movie) for movie in merged_similarities), default=-1) + 1
+
+    # Offsets are indexed directly by movie id, movies without neighbors get an empty range
+    offsets = array("q", [0] * (num_slots + 1))
+    neighbor_ids = array("i")
+    scores = array("f")
+    for movie_id in range(num_slots):
+        for similar_movie in merged_similarities.get(str(movie_id), []):
+            neighbor_ids.append(int(similar_movie["movieId"]))
+            scores.append(similar_movie["avg_score"])
+        offsets[movie_id + 1] = len(neighbor_ids)
+
+    if sys.byteorder != "little":
+        for values in (offsets, neighbor_ids, scores):
+            values.byteswap()
+
+    with open(output_file, "wb") as f:
+        f.write(
+            NEIGHBOR_TABLE_HEADER.pack(
+                NEIGHBOR_TABLE_MAGIC, NEIGHBOR_TABLE_VERSION, num_slots, len(neighbor_ids)
+            )
+        )
+        offsets.tofile(f)
+        neighbor_ids.tofile(f)
+        scores.tofile(f)
+
+    print(f"Neighbor table saved to {output_file}")
+    print(f"Neighbor entries: {len(neighbor_ids)}, movie id slots: {num_slots}")
+
+
+def merge_similarity_files(input_dir, output_file, top_n=50, binary_output_file=None):
     """
     Merge similarity JSON files and average scores for each movie.
 
@@ -12,6 +62,7 @@ def merge_similarity_files(input_dir, output_file, top_n=50):
     - input_dir (str): Directory containing partition similarity JSON files
     - output_file (str): Path to save the merged JSON file
     - top_n (int): Number of top similar movies to keep for each movie
+    - binary_output_file (str): Optional path to also save a binary neighbor table
     """
     # Collect all similarity data
     global_similarities = defaultdict(lambda: defaultdict(list))
@@ -56,6 +107,9 @@ def merge_similarity_files(input_dir, output_file, top_n=50):
     print(f"Merged similarities saved to {output_file}")
     print(f"Total movies with similarities: {len(merged_similarities)}")
 
+    if binary_output_file:
+        write_neighbor_table(merged_similarities, binary_output_file)
+
     # Optional: Print some statistics
     movie_counts = {movie: len(sims) for movie, sims in merged_similarities.items()}
     print(f"Movies with most similar movies:")
@@ -83,10 +137,15 @@ def main():
         default=50,
         help="Number of top similar movies to keep (default: 50)",
     )
+    parser.add_argument(
+        "--binary-output",
+        default=None,
+        help="Optional path to also save a binary neighbor table for the backend (e.g. ./neighbors.bin)",
+    )
 
     args = parser.parse_args()
 
-    merge_similarity_files(args.input, args.output, args.top)
+    merge_similarity_files(args.input, args.output, args.top, args.binary_output)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,51 @@
+import pandas as pd
+import argparse
+
+
+def generate_movie_titles(movies_path, ratings_path, output_file):
+    """
+    Save movie titles with their number of ratings, used by the backend title indexes.
+
+    Args:
+    - movies_path (str): Path to movies CSV file
+    - ratings_path (str): Path to ratings CSV file
+    - output_file (str): Path to save the movie titles CSV file
+    """
+    movies = pd.read_csv(movies_path, usecols=["movieId", "title"])
+    ratings = pd.read_csv(ratings_path, usecols=["movieId"])
+
+    # Number of ratings per movie is used as its popularity
+    rating_counts = ratings["movieId"].value_counts()
+    movies["ratings"] = movies["movieId"].map(rating_counts).fillna(0).astype(int)
+
+    movies.to_csv(output_file, index=False)
+
+    print(f"Movie titles saved to {output_file}")
+    print(f"Total movies: {len(movies)}, rated movies: {(movies['ratings'] > 0).sum()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the movie titles file for the backend")
+    parser.add_argument(
+        "--movies",
+        default="./archive/movie.csv",
+        help="Path to movies CSV file (default: ./archive/movie.csv)",
+    )
+    parser.add_argument(
+        "--ratings",
+        default="./archive/rating.csv",
+        help="Path to ratings CSV file (default: ./archive/rating.csv)",
+    )
+    parser.add_argument(
+        "--output",
+        default="./movie_titles.csv",
+        help="Path to save movie titles (default: ./movie_titles.csv)",
+    )
+
+    args = parser.parse_args()
+
+    generate_movie_titles(args.movies, args.ratings, args.output)
+
+
+if __name__ == "__main__":
+    main()
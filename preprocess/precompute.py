@@ -1,12 +1,245 @@
 import pandas as pd
 import numpy as np
+from scipy.sparse import csr_matrix
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.preprocessing import normalize
+import argparse
+import json
 import os
 
+# Number of rows of the similarity matrix densified at once when writing it
+WRITE_BLOCK_SIZE = 1000
+
+
+def sparse_rating_matrix(ratings):
+    """
+    Build the users x movies rating matrix straight from the rating columns, without a pivot table.
+    Its size grows with the number of ratings rather than with users x movies.
+
+    Args:
+    - ratings (DataFrame): userId, movieId and rating columns, one row per user and movie
+
+    Returns:
+    - matrix (csr_matrix): Ratings, one row per user and one column per movie id
+    - movie_ids (ndarray): Movie id of each column, sorted like the pivot table columns
+    """
+    user_ids, user_rows = np.unique(ratings["userId"].to_numpy(), return_inverse=True)
+    movie_ids, movie_columns = np.unique(ratings["movieId"].to_numpy(), return_inverse=True)
+    matrix = csr_matrix(
+        (ratings["rating"].to_numpy(dtype=np.float64), (user_rows, movie_columns)),
+        shape=(len(user_ids), len(movie_ids)),
+    )
+    return matrix, movie_ids
+
+
+def sparse_cosine_similarity(matrix):
+    """
+    Cosine similarity of the columns of a sparse matrix, as a sparse matrix.
+    Pairs of movies without a common user are never stored.
+    """
+    normalized = normalize(matrix.tocsc(), axis=0)
+    return (normalized.T @ normalized).tocsr()
+
+
+def write_similarity_csv(similarity, movie_ids, output_filename):
+    """
+    Save a sparse similarity matrix in the same CSV format as the dense DataFrame,
+    densifying WRITE_BLOCK_SIZE rows at a time.
+    """
+    with open(output_filename, "w", newline="") as f:
+        for start in range(0, len(movie_ids), WRITE_BLOCK_SIZE):
+            end = min(start + WRITE_BLOCK_SIZE, len(movie_ids))
+            block = pd.DataFrame(
+                similarity[start:end].toarray(), index=movie_ids[start:end], columns=movie_ids
+            )
+            block.index.name = "movieId"
+            block.to_csv(f, header=start == 0)
+
+
+def top_k_rows(blocks, movie_ids, top_k):
+    """
+    Keep the most similar movies of every row of a similarity matrix given in dense
+    row blocks. Like sim_json_generator.py, which takes the top 100 including the movie
+    itself and then drops it, the self entry counts in top_k: top_k - 1 similar movies
+    are kept, zero similarities included, so that merge.py averages the same entries.
+
+    Args:
+    - blocks (iterable): (first row, ndarray of rows) pairs covering the matrix in order
+    - movie_ids (ndarray): Movie id of each row and column
+    - top_k (int): Size of the top list of each movie, the movie itself included
+
+    Yields:
+    - (movie id, list of {"movieId", "score"}) for every movie, best first
+    """
+    k = min(top_k - 1, len(movie_ids) - 1)
+    for start, block in blocks:
+        end = start + len(block)
+        # A movie is not similar to itself
+        block[np.arange(end - start), np.arange(start, end)] = -np.inf
+
+        if k <= 0:
+            for movie_id in movie_ids[start:end]:
+                yield int(movie_id), []
+            continue
+
+        # Only the top k of each row are sorted
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-scores, axis=1, kind="stable")
+        top = np.take_along_axis(top, order, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+
+        for row in range(end - start):
+            yield int(movie_ids[start + row]), [
+                {"movieId": int(movie_ids[column]), "score": float(score)}
+                for column, score in zip(top[row], scores[row])
+            ]
+
+
+def top_k_similarities(matrix, movie_ids, top_k, block_size):
+    """
+    Compute the top list of every movie, block_size rows of the cosine similarity
+    matrix at a time, so that at most block_size x movies similarities are held in memory.
+
+    Args:
+    - matrix (csr_matrix): Users x movies ratings
+    - movie_ids (ndarray): Movie id of each column
+    - top_k (int): Size of the top list of each movie, the movie itself included
+    - block_size (int): Number of movies whose similarities are computed at once
+
+    Yields:
+    - (movie id, list of {"movieId", "score"}) for every movie, best first
+    """
+    normalized = normalize(matrix.tocsc(), axis=0)
+    rows = normalized.T.tocsr()
+
+    def blocks():
+        for start in range(0, len(movie_ids), block_size):
+            yield start, (rows[start:start + block_size] @ normalized).toarray()
+
+    return top_k_rows(blocks(), movie_ids, top_k)
+
+
+def chunk_gram_matrix(ratings, movie_ids):
+    """
+    Dot products of the rating columns of every pair of movies over a chunk of ratings.
+
+    Args:
+    - ratings (DataFrame): userId, movieId and rating columns of whole users
+    - movie_ids (ndarray): Sorted movie ids, the rows and columns of the result
+
+    Returns:
+    - gram (csr_matrix): Movies x movies, only pairs rated by a common user are stored
+    """
+    user_ids, user_rows = np.unique(ratings["userId"].to_numpy(), return_inverse=True)
+    movies = ratings["movieId"].to_numpy()
+    movie_columns = np.minimum(np.searchsorted(movie_ids, movies), len(movie_ids) - 1)
+    if np.any(movie_ids[movie_columns] != movies):
+        raise ValueError("Ratings refer to movies missing from the movies file")
+    matrix = csr_matrix(
+        (ratings["rating"].to_numpy(dtype=np.float64) / 5, (user_rows, movie_columns)),
+        shape=(len(user_ids), len(movie_ids)),
+    )
+    return (matrix.T @ matrix).tocsr()
+
+
+def accumulate_gram_matrix(ratings_path, movie_ids, chunk_size, band_size):
+    """
+    Stream the ratings in chunks and add up the Gram matrices of the chunks. Every
+    user is kept in a single chunk, so the sum is the Gram matrix of all ratings:
+    co-ratings are never split between chunks. The ratings must be sorted by
+    userId, as in the MovieLens files.
+
+    The sum is kept in bands of band_size rows that are added to one at a time, so
+    only one band is held twice while it grows rather than the whole matrix.
+
+    Args:
+    - ratings_path (str): Path to ratings CSV file
+    - movie_ids (ndarray): Sorted movie ids, the rows and columns of the result
+    - chunk_size (int): Number of ratings read at once
+    - band_size (int): Number of rows of each band
+
+    Returns:
+    - bands (list): csr_matrix bands of the movies x movies dot products, band i holds
+      rows i * band_size to (i + 1) * band_size, the diagonal holds the squared norms
+    """
+    starts = range(0, len(movie_ids), band_size)
+    bands = [
+        csr_matrix((min(band_size, len(movie_ids) - start), len(movie_ids)), dtype=np.float64) for start in starts
+    ]
+
+    def add(gram):
+        for i, start in enumerate(starts):
+            bands[i] = bands[i] + gram[start:start + band_size]
+
+    carried = None
+    last_complete_user = None
+    chunks = pd.read_csv(
+        ratings_path,
+        usecols=["userId", "movieId", "rating"],
+        dtype={"userId": np.int32, "movieId": np.int32, "rating": np.float64},
+        chunksize=chunk_size,
+    )
+    for number, chunk in enumerate(chunks, 1):
+        if carried is not None:
+            chunk = pd.concat([carried, chunk])
+        users = chunk["userId"].to_numpy()
+        if np.any(users[1:] < users[:-1]) or (last_complete_user is not None and users[0] <= last_complete_user):
+            raise ValueError("Ratings must be sorted by userId in global mode")
+
+        # The last user of the chunk may go on in the next chunk
+        split = int(np.searchsorted(users, users[-1]))
+        carried = chunk.iloc[split:]
+        if split > 0:
+            add(chunk_gram_matrix(chunk.iloc[:split], movie_ids))
+            last_complete_user = users[split - 1]
+        print(f"Chunk {number}: {len(chunk)} ratings, accumulated pairs: {sum(band.nnz for band in bands)}")
+
+    if carried is not None and len(carried):
+        add(chunk_gram_matrix(carried, movie_ids))
+    return bands
+
+
+def global_top_k_similarities(bands, movie_ids, top_k, band_size):
+    """
+    Compute the top list of every rated movie from the bands of a
+    Gram matrix, dividing the dot products by the norms one band at a time.
+
+    Yields:
+    - (movie id, list of {"movieId", "score"}) for every rated movie, best first
+    """
+    norms = np.sqrt(np.concatenate([band.diagonal(i * band_size) for i, band in enumerate(bands)]))
+    rated = np.flatnonzero(norms > 0)
+    inverse_norms = 1 / norms[rated]
+
+    def blocks():
+        for i, band in enumerate(bands):
+            # Positions in rated of the rated rows of the band
+            first, last = np.searchsorted(rated, [i * band_size, (i + 1) * band_size])
+            if first == last:
+                continue
+            block = band[rated[first:last] - i * band_size][:, rated].toarray()
+            block *= inverse_norms[first:last, None]
+            block *= inverse_norms[None, :]
+            yield int(first), block
+
+    return top_k_rows(blocks(), movie_ids[rated], top_k)
+
+
+def write_similarity_json(similarities, output_filename):
+    """
+    Save (movie id, similar movies) pairs as they are computed, in the JSON format
+    of sim_json_generator.py, read by merge.py.
+    """
+    with open(output_filename, "w") as f:
+        f.write("{")
+        for i, (movie_id, similar_movies) in enumerate(similarities):
+            f.write(("," if i else "") + f'\n  "{movie_id}": ' + json.dumps(similar_movies))
+        f.write("\n}\n")
+
 
 def process_movie_similarity(
-    movies_path, ratings_path, output_dir, partition_size=2000000
+    movies_path, ratings_path, output_dir, partition_size=2000000, mode="sparse", top_k=100, block_size=1000
 ):
     """
     Process movie similarity in partitions and save cosine similarity tables as CSV files.
@@ -16,16 +249,47 @@ def process_movie_similarity(
     - ratings_path (str): Path to ratings CSV file
     - output_dir (str): Directory to save output CSV files
     - partition_size (int): Number of rows to process in each partition
+    - mode (str): "sparse" to compute the similarities with sparse matrices, "dense"
+      to use a dense pivot table, which needs users x movies memory per partition,
+      "topk" to only save the top_k similar movies of every movie as the JSON files
+      of sim_json_generator.py, without ever holding the movies x movies matrix,
+      "global" to stream the ratings in chunks of partition_size and save the top_k
+      movies by exact cosine similarity over all users as a single JSON file in
+      output_dir/global
+    - top_k (int): Size of the top list of each movie in topk and global modes, the
+      movie itself included as in sim_json_generator.py, so top_k - 1 similar movies are saved
+    - block_size (int): Number of movies whose similarities are computed at once in topk and global modes
     """
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
 
+    if mode == "global":
+        # The Gram matrix of all users is accumulated chunk by chunk, the norms are only divided out at the end
+        movie_ids = np.unique(pd.read_csv(movies_path, usecols=["movieId"])["movieId"].to_numpy(dtype=np.int32))
+        bands = accumulate_gram_matrix(ratings_path, movie_ids, partition_size, block_size)
+
+        # A single partition for merge.py, whose average is then the exact similarity. It gets
+        # its own directory, merge.py would otherwise average it with partition files of other modes.
+        global_dir = os.path.join(output_dir, "global")
+        os.makedirs(global_dir, exist_ok=True)
+        output_filename = os.path.join(global_dir, "partition_global_similarities.json")
+        write_similarity_json(global_top_k_similarities(bands, movie_ids, top_k, block_size), output_filename)
+
+        print(f"Saved top {top_k - 1} similar movies over all users to {output_filename}")
+        print(f"Movie pairs with a common user: {sum(band.nnz for band in bands)}")
+        print(f"Merge it on its own: python merge.py --input {global_dir}")
+        return
+
     # Read datasets
     movies = pd.read_csv(movies_path)
-    ratings = pd.read_csv(ratings_path)
+    # Timestamps are never used, as strings they would take more memory than all other columns
+    ratings = pd.read_csv(
+        ratings_path,
+        usecols=["userId", "movieId", "rating"],
+        dtype={"userId": np.int32, "movieId": np.int32, "rating": np.float64},
+    )
 
     # Preprocessing
-    ratings = ratings.drop(["timestamp"], axis=1)
     ratings["rating"] /= 5
     movies = movies.drop(["genres"], axis=1)
     ratings = ratings.sort_values("userId")
@@ -47,6 +311,49 @@ def process_movie_similarity(
         # Slice the current partition
         ratings_partition = ratings.iloc[start_idx:end_idx]
 
+        output_filename = os.path.join(
+            output_dir, f"cosine_similarity_partition_{partition + 1}.csv"
+        )
+
+        if mode == "topk":
+            rating_matrix, movie_ids = sparse_rating_matrix(ratings_partition)
+            print(f"Rating matrix shape: {rating_matrix.shape}, ratings: {rating_matrix.nnz}")
+
+            if rating_matrix.nnz == 0:
+                print(f"Skipping empty partition {partition + 1}")
+                continue
+
+            # Same name as the files of sim_json_generator.py, so merge.py can read them directly
+            output_filename = os.path.join(
+                output_dir, f"partition_cosine_similarity_partition_{partition + 1}_similarities.json"
+            )
+            write_similarity_json(
+                top_k_similarities(rating_matrix, movie_ids, top_k, block_size), output_filename
+            )
+
+            print(
+                f"Saved top {top_k - 1} similar movies for partition {partition + 1} to {output_filename}"
+            )
+            continue
+
+        if mode == "sparse":
+            # Ratings go straight into a sparse matrix, no cell is stored for unrated movies
+            rating_matrix, movie_ids = sparse_rating_matrix(ratings_partition)
+            print(f"Rating matrix shape: {rating_matrix.shape}, ratings: {rating_matrix.nnz}")
+
+            if rating_matrix.nnz == 0:
+                print(f"Skipping empty partition {partition + 1}")
+                continue
+
+            cosine_sim = sparse_cosine_similarity(rating_matrix)
+            write_similarity_csv(cosine_sim, movie_ids, output_filename)
+
+            print(
+                f"Saved cosine similarity for partition {partition + 1} to {output_filename}"
+            )
+            print(f"Cosine similarity matrix shape: {cosine_sim.shape}, stored pairs: {cosine_sim.nnz}")
+            continue
+
         # Create pivot table
         pivot_table = ratings_partition.pivot_table(
             index=["userId"], columns=["movieId"], values="rating"
@@ -72,9 +379,6 @@ def process_movie_similarity(
         )
 
         # Save to CSV
-        output_filename = os.path.join(
-            output_dir, f"cosine_similarity_partition_{partition + 1}.csv"
-        )
         cosine_sim_df.to_csv(output_filename)
 
         print(
@@ -83,10 +387,57 @@ def process_movie_similarity(
         print(f"Cosine similarity matrix shape: {cosine_sim_df.shape}")
 
 
-# Example usage
-if __name__ == "__main__":
-    movies_path = "./archive/movie.csv"
-    ratings_path = "./archive/rating.csv"
-    output_directory = "./cosine_similarity_outputs"
+def main():
+    parser = argparse.ArgumentParser(description="Compute movie cosine similarities per partition of ratings")
+    parser.add_argument(
+        "--movies",
+        default="./archive/movie.csv",
+        help="Path to movies CSV file (default: ./archive/movie.csv)",
+    )
+    parser.add_argument(
+        "--ratings",
+        default="./archive/rating.csv",
+        help="Path to ratings CSV file (default: ./archive/rating.csv)",
+    )
+    parser.add_argument(
+        "--output",
+        default="./cosine_similarity_outputs",
+        help="Directory to save the similarity CSV files (default: ./cosine_similarity_outputs)",
+    )
+    parser.add_argument(
+        "--partition-size",
+        type=int,
+        default=2000000,
+        help="Number of ratings per partition, or read at once in global mode (default: 2000000)",
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["sparse", "dense", "topk", "global"],
+        default="sparse",
+        help="sparse builds the rating matrix without a dense pivot table, topk also saves only "
+        "the top similar movies of each movie as JSON for merge.py, global streams the ratings "
+        "and saves the top similar movies by exact similarity over all users (default: sparse)",
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=100,
+        help="Size of the top list of each movie in topk and global modes, the movie itself "
+        "included as in sim_json_generator.py (default: 100, i.e. 99 similar movies)",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=1000,
+        help="Number of movies whose similarities are computed at once in topk and global modes (default: 1000)",
+    )
+
+    args = parser.parse_args()
+
+    process_movie_similarity(
+        args.movies, args.ratings, args.output, args.partition_size, args.mode, args.top_k, args.block_size
+    )
 
-    process_movie_similarity(movies_path, ratings_path, output_directory)
+
+if __name__ == "__main__":
+    main()